@@ -0,0 +1,24 @@
+import argparse
+
+from alcazar.static import collect_static
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="alcazar")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    collectstatic = commands.add_parser("collectstatic", help="fingerprint and precompress static files")
+    collectstatic.add_argument("--static-dir", default="static")
+    collectstatic.add_argument("--output-dir", default=None)
+    collectstatic.add_argument("--no-compress", dest="compress", action="store_false")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "collectstatic":
+        manifest = collect_static(args.static_dir, output_dir=args.output_dir, compress=args.compress)
+        print(f"{len(manifest)} static files collected.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,68 @@
+import asyncio
+import contextvars
+import functools
+import inspect
 import os
-from whitenoise import WhiteNoise
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
 from requests import Session as RequestsSession
 
+from .encoders import get_json_encoder
 from .exceptions import HTTPError
 from .error_handlers import debug_exception_handler
+from .metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from .middleware import Middleware
+from .profiling import current_profile, sample_current_thread
 from .route import Route
+from .router import Router, RouteCache
+from .static import StaticFiles
 from .responses import Response
-from .templates import get_templates_env
-from .utils import empty_wsgi_app, cut_static_root, request_for_static
+from .tracing import span, use_span, TracedBody, traced_start_response, traced_send
+from .templates import get_templates_env, compile_templates, generate_buffered
+from .utils import (
+    generate_etag, cut_static_root, request_for_static,
+    read_body, build_environ, start_wsgi, send_body, encode_headers, handle_lifespan,
+)
 
 
 class Alcazar:
-    def __init__(self, templates_dir="templates", static_dir="static", debug=True):
-        self.templates = get_templates_env(os.path.abspath(templates_dir))
+    def __init__(self, templates_dir="templates", static_dir="static", debug=True, route_cache_size=None,
+                 max_workers=None, response_class=Response, json_encoder="stdlib",
+                 etags=False, static_autorefresh=False, templates_cache_dir=None,
+                 precompile_templates=False, metrics=False, metrics_path="/metrics", metrics_dir=None,
+                 tracer=None):
+        self.templates = get_templates_env(os.path.abspath(templates_dir), bytecode_cache_dir=templates_cache_dir)
         self.static_dir = os.path.abspath(static_dir)
         self._static_root = "/static"
+        self.static = StaticFiles(self.static_dir, autorefresh=static_autorefresh)
+        self.templates.globals["static"] = self.static_url
+        if precompile_templates is True:
+            compile_templates(self.templates)
+        elif precompile_templates:
+            compile_templates(self.templates, extensions=precompile_templates)
         self._debug = debug
         self._routes = {}
+        self._router = Router()
+        self._route_cache = RouteCache(route_cache_size) if route_cache_size else None
         self._exception_handler = None
         self._middleware = Middleware(self)
+        self._response_class = response_class
+        self._json_encoder = get_json_encoder(json_encoder)
+        self._etags = etags
+
+        # per-route request metrics, served in Prometheus format at `metrics_path`
+        self.metrics = Metrics(multiprocess_dir=metrics_dir) if metrics else None
+        if self.metrics is not None:
+            self.add_route(metrics_path, self._metrics_handler, methods=["get"])
+
+        self.tracer = tracer
+
+        # thread pool for sync handlers served through ASGI
+        self._max_workers = max_workers
+        self._executor = None
 
         # cached requests session
         self._session = None
@@ -29,22 +71,33 @@ class Alcazar:
     def debug(self):
         return self._debug
 
+    @property
+    def route_cache(self):
+        return self._route_cache
+
     def add_middleware(self, middleware_cls, **kwargs):
         self._middleware.add(middleware_cls, **kwargs)
 
-    def route(self, pattern, methods=None):
+    def route(self, pattern, methods=None, singleton=False, etag=None, cache=None):
         """ Decorator that adds a new route """
         def wrapper(handler):
-            self.add_route(pattern, handler, methods)
+            self.add_route(pattern, handler, methods, singleton=singleton, etag=etag, cache=cache)
             return handler
 
         return wrapper
 
-    def add_route(self, pattern, handler, methods=None):
+    def add_route(self, pattern, handler, methods=None, singleton=False, etag=None, cache=None):
         """ Add a new route """
         assert pattern not in self._routes
 
-        self._routes[pattern] = Route(path_pattern=pattern, handler=handler, methods=methods)
+        route = Route(
+            path_pattern=pattern, handler=handler, methods=methods, singleton=singleton, etag=etag, cache=cache,
+        )
+        self._routes[pattern] = route
+        self._router.add(pattern, route)
+
+        if self._route_cache is not None:
+            self._route_cache.clear()
 
     def add_exception_handler(self, handler):
         self._exception_handler = handler
@@ -58,34 +111,165 @@ class Alcazar:
 
             debug_exception_handler(request, response, exception)
 
+    def static_url(self, name):
+        """ URL of a static file, pointing at its content-hashed name after `collect_static` """
+        return self._static_root + self.static.url_for(name)
+
     def template(self, name, context=None):
         if context is None:
             context = {}
 
-        return self.templates.get_template(name).render(**context)
+        with span("template", template=name):
+            return self.templates.get_template(name).render(**context)
+
+    def stream_template(self, name, context=None, buffer_size=8192):
+        """ Render a template incrementally, for use as a streaming response body """
+        if context is None:
+            context = {}
+
+        return self._stream_template(self.templates.get_template(name), context, buffer_size)
+
+    def _stream_template(self, template, context, buffer_size):
+        with span("template", template=template.name):
+            yield from generate_buffered(template, context, buffer_size=buffer_size)
+
+    def make_response(self):
+        return self._response_class(json_encoder=self._json_encoder)
+
+    def _metrics_handler(self, request, response):
+        response.body = self.metrics.render()
+        response.content_type = METRICS_CONTENT_TYPE
 
     def dispatch_request(self, request):
-        response = Response()
+        route, kwargs = self.find_route(path=request.path)
+
+        if self.metrics is None:
+            return self._handle(request, route, kwargs)
+
+        label = self.metrics.route_label(route)
+        self.metrics.request_started(label)
+        started = time.perf_counter()
+        status_code = 500
+        try:
+            response = self._handle(request, route, kwargs)
+            status_code = response.status_code
+            return response
+        except HTTPError as e:
+            status_code = e.status
+            raise
+        finally:
+            self.metrics.request_finished(label, status_code, time.perf_counter() - started)
 
+    async def dispatch_request_async(self, request):
         route, kwargs = self.find_route(path=request.path)
 
+        if self.metrics is None:
+            return await self._handle_async(request, route, kwargs)
+
+        label = self.metrics.route_label(route)
+        self.metrics.request_started(label)
+        started = time.perf_counter()
+        status_code = 500
+        try:
+            response = await self._handle_async(request, route, kwargs)
+            status_code = response.status_code
+            return response
+        except HTTPError as e:
+            status_code = e.status
+            raise
+        finally:
+            self.metrics.request_finished(label, status_code, time.perf_counter() - started)
+
+    def _handle(self, request, route, kwargs):
+        response = self.make_response()
+
         try:
             if route is None:
                 raise HTTPError(status=404)
 
-            route.handle_request(request, response, **kwargs)
+            with span("handler", route=route.path_pattern):
+                route.handle_request(request, response, **kwargs)
+            self._check_handler_validators(route, request, response)
         except Exception as e:
             self._handle_exception(request, response, e)
 
         return response
 
+    async def _handle_async(self, request, route, kwargs):
+        response = self.make_response()
+
+        try:
+            if route is None:
+                raise HTTPError(status=404)
+
+            handler = route.get_handler(request.method)
+            with span("handler", route=route.path_pattern):
+                if inspect.iscoroutinefunction(handler):
+                    with sample_current_thread(sys._getframe()):
+                        await handler(request, response, **kwargs)
+                else:
+                    await self.run_sync(handler, request, response, **kwargs)
+            self._check_handler_validators(route, request, response)
+        except Exception as e:
+            self._handle_exception(request, response, e)
+
+        return response
+
+    @staticmethod
+    def _check_handler_validators(route, request, response):
+        """ Answer conditional requests early when the handler set its own validators """
+        response._auto_etag = route.etag
+        if response.status_code == 200 and (response.etag is not None or response.last_modified is not None):
+            response.not_modified(request)
+
+    def check_preconditions(self, request, response):
+        """
+        Add a weak ETag computed from the final body when enabled and answer
+        matching conditional requests with a 304. Runs after all middleware.
+        """
+        if response.status_code != 200:
+            return
+
+        use_etag = self._etags if response._auto_etag is None else response._auto_etag
+        if use_etag and response.etag is None and not response.is_streamed:
+            response.etag = generate_etag(response.finalize())
+
+        if response.etag is not None or response.last_modified is not None:
+            response.not_modified(request)
+
+    async def run_sync(self, func, *args, **kwargs):
+        """ Run a blocking callable in the bounded thread pool """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+
+        profile = current_profile()
+        if profile is not None:
+            func = functools.partial(profile.run, func)
+
+        # run in a copy of the current context, so the call sees the request's trace
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(context.run, func, *args, **kwargs))
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
     def find_route(self, path):
-        for pattern, route in self._routes.items():
-            matched, kwargs = route.match(request_path=path)
-            if matched is True:
-                return route, kwargs
+        with span("find_route"):
+            return self._find_route(path)
+
+    def _find_route(self, path):
+        if self._route_cache is None:
+            return self._router.find(path)
+
+        result = self._route_cache.get(path)
+        if result is None:
+            result = self._router.find(path)
+            self._route_cache.set(path, result)
 
-        return None, {}
+        return result
 
     def session(self, base_url="http://testserver"):
         """Cached Testing HTTP client based on Requests by Kenneth Reitz."""
@@ -95,15 +279,55 @@ class Alcazar:
             self._session = session
         return self._session
 
-    def as_whitenoise_app(self, environ, start_response):
-        white_noise = WhiteNoise(empty_wsgi_app(), root=self.static_dir)
-        return white_noise(environ, start_response)
-
     def __call__(self, environ, start_response):
         path_info = environ["PATH_INFO"]
 
         if request_for_static(path_info, self._static_root):
             environ["PATH_INFO"] = cut_static_root(path_info, self._static_root)
-            return self.as_whitenoise_app(environ, start_response)
+            return self.static(environ, start_response)
+
+        if self.tracer is None:
+            return self._middleware(environ, start_response)
+
+        root = self.tracer.trace("request", method=environ["REQUEST_METHOD"], path=path_info)
+        root.begin()
+        start_response = traced_start_response(start_response, root, self.tracer.server_timing)
+        try:
+            with use_span(root):
+                app_iter = self._middleware(environ, start_response)
+        except BaseException as e:
+            root.finish(type(e))
+            raise
+
+        if isinstance(app_iter, list):
+            root.finish()
+            return app_iter
+
+        # streamed bodies are produced after this returns, the trace ends when the server closes them
+        return TracedBody(app_iter, root)
+
+    async def asgi(self, scope, receive, send):
+        """ ASGI 3 entry point, e.g. `uvicorn app:app.asgi` """
+        if scope["type"] == "lifespan":
+            await handle_lifespan(receive, send, on_shutdown=self._shutdown_executor)
+            return
+
+        assert scope["type"] == "http", f"Unsupported ASGI scope type: {scope['type']}"
+
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        path_info = environ["PATH_INFO"]
+
+        if request_for_static(path_info, self._static_root):
+            environ["PATH_INFO"] = cut_static_root(path_info, self._static_root)
+            status, headers, app_iter = await self.run_sync(start_wsgi, self.static, environ)
+            await send({"type": "http.response.start", "status": status, "headers": encode_headers(headers)})
+            await send_body(send, app_iter, self.run_sync)
+            return
+
+        if self.tracer is None:
+            await self._middleware.asgi(environ, send)
+            return
 
-        return self._middleware(environ, start_response)
+        with self.tracer.trace("request", method=environ["REQUEST_METHOD"], path=path_info) as root:
+            await self._middleware.asgi(environ, traced_send(send, root, self.tracer.server_timing))
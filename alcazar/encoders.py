@@ -0,0 +1,79 @@
+import json
+from abc import ABC, abstractmethod
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+class JSONEncoder(ABC):
+    """ Base class for JSON encoder backends that encode straight to bytes """
+
+    name = None
+
+    @abstractmethod
+    def dumps(self, obj):
+        """ Encode `obj` to JSON bytes """
+
+    def iter_list(self, items, buffer_size=64 * 1024):
+        """ Encode an iterable as a JSON array, item by item, in chunks of about `buffer_size` bytes """
+        buffer = [b"["]
+        buffered = 1
+        separator = b""
+
+        for item in items:
+            encoded = self.dumps(item)
+            buffer.append(separator)
+            buffer.append(encoded)
+            buffered += len(encoded) + 1
+            separator = b","
+
+            if buffered >= buffer_size:
+                yield b"".join(buffer)
+                buffer = []
+                buffered = 0
+
+        buffer.append(b"]")
+        yield b"".join(buffer)
+
+
+class StdlibJSONEncoder(JSONEncoder):
+    name = "stdlib"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode('UTF-8')
+
+
+class OrjsonEncoder(JSONEncoder):
+    name = "orjson"
+
+    def __init__(self):
+        assert orjson is not None, "orjson is not installed. Install it with `pip install orjson`."
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+JSON_ENCODERS = {
+    StdlibJSONEncoder.name: StdlibJSONEncoder,
+    OrjsonEncoder.name: OrjsonEncoder,
+}
+
+
+def get_json_encoder(name="stdlib"):
+    """ Return a JSON encoder by name. `auto` picks the fastest one that is installed """
+    if isinstance(name, JSONEncoder):
+        return name
+
+    if name == "auto":
+        name = OrjsonEncoder.name if orjson is not None else StdlibJSONEncoder.name
+
+    assert name in JSON_ENCODERS, f"Unknown JSON encoder: {name}"
+    return JSON_ENCODERS[name]()
+
+
+default_json_encoder = StdlibJSONEncoder()
@@ -0,0 +1,326 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+ARCHIVE_FILE = "archive.json"
+
+ARCHIVE_LOCK_FILE = "archive.lock"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class RouteMetrics:
+    """ Counters of a single route pattern """
+
+    __slots__ = ("statuses", "buckets", "sum", "count", "in_flight")
+
+    def __init__(self, bucket_count):
+        self.statuses = {}
+        # one counter per bucket plus +Inf, not cumulative
+        self.buckets = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.in_flight = 0
+
+    def to_dict(self):
+        return {
+            "statuses": dict(self.statuses),
+            "buckets": list(self.buckets),
+            "sum": self.sum,
+            "count": self.count,
+            "in_flight": self.in_flight,
+        }
+
+
+def _start_flusher(metrics):
+    # only a weak reference, so the thread does not keep an unused `Metrics` alive
+    ref = weakref.ref(metrics)
+    interval = metrics.flush_interval
+
+    def run():
+        while True:
+            time.sleep(interval)
+            metrics = ref()
+            if metrics is None:
+                return
+            metrics.flush()
+            del metrics
+
+    threading.Thread(target=run, name="alcazar-metrics", daemon=True).start()
+
+
+def _flush_at_exit(ref):
+    metrics = ref()
+    if metrics is not None and metrics._pid == os.getpid():
+        metrics.flush()
+
+
+class Metrics:
+    """
+    Per-route request counts, status classes, latency histograms and in-flight gauges.
+
+    Routes are labelled by their pattern, so `/users/{id}` is a single series
+    however many users are requested. With `multiprocess_dir` every worker
+    process writes its counters to its own file there from a background
+    thread every `flush_interval` seconds and at exit, and `render` sums the
+    files of all workers. Files of exited workers are folded into a single
+    archive file when metrics are collected.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, multiprocess_dir=None, flush_interval=1.0):
+        self.buckets = tuple(sorted(buckets))
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._routes = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._worker_file = None
+        # bumped on every change, so an idle worker does not rewrite its file
+        self._version = 0
+        self._flushed_version = None
+
+        if multiprocess_dir is not None:
+            os.makedirs(multiprocess_dir, exist_ok=True)
+            atexit.register(_flush_at_exit, weakref.ref(self))
+
+    @staticmethod
+    def route_label(route):
+        return UNMATCHED_ROUTE if route is None else route.path_pattern
+
+    def _check_worker(self):
+        """ Start counting from zero in a new file when running in a freshly forked worker """
+        pid = os.getpid()
+        if pid != self._pid:
+            # the start time tells a recycled pid apart from the exited worker that had it before
+            self._pid = pid
+            self._worker_file = os.path.join(self.multiprocess_dir, f"metrics-{pid}-{time.time_ns()}.json")
+            self._routes = {}
+            self._version = 0
+            self._flushed_version = None
+            # threads do not survive a fork, every worker starts its own
+            _start_flusher(self)
+
+    def _get(self, label):
+        if self.multiprocess_dir is not None:
+            self._check_worker()
+            self._version += 1
+
+        metrics = self._routes.get(label)
+        if metrics is None:
+            metrics = self._routes[label] = RouteMetrics(len(self.buckets))
+        return metrics
+
+    def request_started(self, label):
+        with self._lock:
+            self._get(label).in_flight += 1
+
+    def request_finished(self, label, status_code, duration):
+        status_class = f"{status_code // 100}xx"
+        bucket = bisect.bisect_left(self.buckets, duration)
+
+        with self._lock:
+            metrics = self._get(label)
+            metrics.in_flight -= 1
+            metrics.statuses[status_class] = metrics.statuses.get(status_class, 0) + 1
+            metrics.buckets[bucket] += 1
+            metrics.sum += duration
+            metrics.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {label: metrics.to_dict() for label, metrics in self._routes.items()}
+
+    def flush(self):
+        """ Write this process's counters to its file in `multiprocess_dir` if they changed since the last write """
+        # the write happens outside of the counters' lock, so requests never wait for the disk
+        with self._flush_lock:
+            with self._lock:
+                self._check_worker()
+                if self._version == self._flushed_version:
+                    return
+                self._flushed_version = self._version
+                path = self._worker_file
+                routes = {label: metrics.to_dict() for label, metrics in self._routes.items()}
+
+            _write_json(path, {"buckets": self.buckets, "routes": routes})
+
+    def _worker_files(self):
+        """ `(path, pid, start time)` of every worker file in `multiprocess_dir` """
+        files = []
+        for path in glob.glob(os.path.join(self.multiprocess_dir, "metrics-*-*.json")):
+            try:
+                pid, started = os.path.basename(path)[len("metrics-"):-len(".json")].split("-")
+                files.append((path, int(pid), int(started)))
+            except ValueError:
+                continue
+        return files
+
+    def collect(self):
+        """ Counters of this process, or of all worker processes when `multiprocess_dir` is set """
+        if self.multiprocess_dir is None:
+            return self.snapshot()
+
+        self.flush()
+
+        workers = self._worker_files()
+        latest = {}
+        for path, pid, started in workers:
+            latest[pid] = max(latest.get(pid, started), started)
+
+        # a worker is gone when its pid is not running or now belongs to a newer worker
+        live, exited = [], []
+        for path, pid, started in workers:
+            if started == latest[pid] and _pid_is_alive(pid):
+                live.append(path)
+            else:
+                exited.append(path)
+
+        if exited and fcntl is not None:
+            self._archive(exited)
+            exited = []
+
+        collected = {}
+        # counters of exited workers still count, their in-flight requests do not
+        for path in [os.path.join(self.multiprocess_dir, ARCHIVE_FILE)] + exited:
+            self._merge(collected, _read_json(path), in_flight=False)
+        for path in live:
+            self._merge(collected, _read_json(path), in_flight=True)
+
+        return collected
+
+    def _archive(self, paths):
+        """ Fold the files of exited workers into the archive file and remove them """
+        archive_path = os.path.join(self.multiprocess_dir, ARCHIVE_FILE)
+
+        with open(os.path.join(self.multiprocess_dir, ARCHIVE_LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            archive = _read_json(archive_path)
+            if archive is None or tuple(archive["buckets"]) != self.buckets:
+                archive = {"buckets": self.buckets, "routes": {}, "folded": []}
+
+            # names of folded files that could not be removed yet, so they are not counted twice
+            folded = [
+                name for name in archive["folded"]
+                if os.path.exists(os.path.join(self.multiprocess_dir, name))
+            ]
+            for path in paths:
+                name = os.path.basename(path)
+                if name not in folded:
+                    self._merge(archive["routes"], _read_json(path), in_flight=False)
+                    folded.append(name)
+
+            archive["folded"] = folded
+            _write_json(archive_path, archive)
+
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _merge(self, collected, data, in_flight):
+        if data is None or tuple(data["buckets"]) != self.buckets:
+            return
+
+        for label, metrics in data["routes"].items():
+            total = collected.get(label)
+            if total is None:
+                total = collected[label] = RouteMetrics(len(self.buckets)).to_dict()
+            for status_class, count in metrics["statuses"].items():
+                total["statuses"][status_class] = total["statuses"].get(status_class, 0) + count
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], metrics["buckets"])]
+            total["sum"] += metrics["sum"]
+            total["count"] += metrics["count"]
+            if in_flight:
+                total["in_flight"] += metrics["in_flight"]
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        routes = sorted(self.collect().items())
+        bounds = self.buckets + (float("inf"),)
+
+        lines = [
+            "# HELP alcazar_requests_total Total number of requests by route and status class.",
+            "# TYPE alcazar_requests_total counter",
+        ]
+        for label, metrics in routes:
+            route = escape_label(label)
+            for status_class, count in sorted(metrics["statuses"].items()):
+                lines.append(f'alcazar_requests_total{{route="{route}",status="{status_class}"}} {count}')
+
+        lines += [
+            "# HELP alcazar_request_duration_seconds Request latency by route.",
+            "# TYPE alcazar_request_duration_seconds histogram",
+        ]
+        for label, metrics in routes:
+            route = escape_label(label)
+            cumulative = 0
+            for bound, count in zip(bounds, metrics["buckets"]):
+                cumulative += count
+                le = format_value(bound)
+                lines.append(f'alcazar_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {cumulative}')
+            lines.append(f'alcazar_request_duration_seconds_sum{{route="{route}"}} {format_value(metrics["sum"])}')
+            lines.append(f'alcazar_request_duration_seconds_count{{route="{route}"}} {metrics["count"]}')
+
+        lines += [
+            "# HELP alcazar_requests_in_flight Requests currently being handled by route.",
+            "# TYPE alcazar_requests_in_flight gauge",
+        ]
+        for label, metrics in routes:
+            lines.append(f'alcazar_requests_in_flight{{route="{escape_label(label)}"}} {metrics["in_flight"]}')
+
+        return "\n".join(lines) + "\n"
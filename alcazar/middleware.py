@@ -1,27 +1,550 @@
+import asyncio
+import hashlib
+import hmac
+import inspect
+import random
+import sys
+import threading
+import time
+import zlib
+
+from alcazar.metrics import UNMATCHED_ROUTE
+from alcazar.profiling import Profile, StackAggregator, profile_token, use_profile
 from alcazar.requests import Request
+from alcazar.tracing import span
+from alcazar.utils.conditional import quote_etag
+from alcazar.utils.cache import LRUCache
+
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def add_vary(headers, header_name):
+    vary = [value.strip() for value in headers.get("Vary", "").split(",") if value.strip()]
+    if header_name.lower() not in (value.lower() for value in vary):
+        vary.append(header_name)
+    headers["Vary"] = ", ".join(vary)
+
+
+def parse_accept_encoding(header):
+    """ Return the set of content codings the client accepts """
+    accepted = set()
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+def _call_sync(hook, *args):
+    """ Call a middleware hook on the WSGI path, where async hooks cannot be awaited """
+    result = hook(*args)
+    if inspect.isawaitable(result):
+        if inspect.iscoroutine(result):
+            result.close()
+        raise AssertionError(f"{hook.__qualname__} is async. Async middleware hooks are only supported under ASGI.")
+    return result
+
+
+def _overrides(middleware, name):
+    return getattr(type(middleware), name) is not getattr(Middleware, name)
 
 
 class Middleware:
     def __init__(self, app):
         self.app = app
+        self._pipeline = None
 
     def add(self, middleware_cls, **kwargs):
         self.app = middleware_cls(self.app, **kwargs)
+        self._pipeline = None
+
+    @property
+    def root_app(self):
+        """ The application at the bottom of the middleware chain """
+        app = self.app
+        while isinstance(app, Middleware):
+            app = app.app
+        return app
+
+    @property
+    def pipeline(self):
+        """ The middleware chain below this one, compiled into a flat pipeline on first use """
+        if self._pipeline is None:
+            self._pipeline = Pipeline(self.app)
+        return self._pipeline
 
     def process_request(self, req):
+        """ Called before the handler. Returning a response skips the rest of the chain and the handler """
         pass
 
     def process_response(self, req, resp):
         pass
 
+    def process_exception(self, req, exception):
+        """ Called when the rest of the chain raised, before the exception propagates """
+        pass
+
     def dispatch_request(self, request):
-        self.process_request(request)
-        response = self.app.dispatch_request(request)
-        self.process_response(request, response)
+        response = _call_sync(self.process_request, request)
+        if response is None:
+            try:
+                # the layers below stay flattened even when this one overrides dispatch
+                response = self.pipeline.dispatch_request(request)
+            except Exception as e:
+                _call_sync(self.process_exception, request, e)
+                raise
+        _call_sync(self.process_response, request, response)
+
+        return response
+
+    async def dispatch_request_async(self, request):
+        response = await _maybe_await(self.process_request(request))
+        if response is None:
+            try:
+                response = await self.pipeline.dispatch_request_async(request)
+            except Exception as e:
+                await _maybe_await(self.process_exception(request, e))
+                raise
+        await _maybe_await(self.process_response(request, response))
 
         return response
 
     def __call__(self, environ, start_response):
         request = Request(environ)
-        response = self.app.dispatch_request(request)
+        response = self.pipeline.dispatch_request(request)
+        self.root_app.check_preconditions(request, response)
         return response(environ, start_response)
+
+    async def asgi(self, environ, send):
+        request = Request(environ)
+        response = await self.pipeline.dispatch_request_async(request)
+        root_app = self.root_app
+        root_app.check_preconditions(request, response)
+        await response.asgi(environ, send, run_sync=root_app.run_sync)
+
+
+class Pipeline:
+    """
+    A middleware chain flattened into lists of hooks.
+
+    Requests go through the `process_request` hooks outermost first and
+    responses through the `process_response` hooks innermost first, without
+    recursing through every layer. Hooks a middleware does not override are
+    skipped. A middleware that overrides `dispatch_request` itself ends the
+    flat part of the pipeline and dispatches the layers below it through
+    its own pipeline.
+    """
+
+    def __init__(self, app):
+        self.middlewares = []
+        while isinstance(app, Middleware) and not (
+            _overrides(app, "dispatch_request") or _overrides(app, "dispatch_request_async")
+        ):
+            self.middlewares.append(app)
+            app = app.app
+
+        self.app = app
+
+        layers = list(enumerate(self.middlewares))
+        self.request_hooks = [
+            (index, middleware.process_request)
+            for index, middleware in layers if _overrides(middleware, "process_request")
+        ]
+        self.response_hooks = [
+            (index, middleware.process_response)
+            for index, middleware in reversed(layers) if _overrides(middleware, "process_response")
+        ]
+        self.exception_hooks = [
+            (index, middleware.process_exception)
+            for index, middleware in reversed(layers) if _overrides(middleware, "process_exception")
+        ]
+
+    def dispatch_request(self, request):
+        # number of layers the request entered, whose response/exception hooks must run
+        depth = len(self.middlewares)
+        response = None
+
+        try:
+            with span("middleware.process_request"):
+                for index, hook in self.request_hooks:
+                    depth = index + 1
+                    response = _call_sync(hook, request)
+                    if response is not None:
+                        break
+            if response is None:
+                depth = len(self.middlewares)
+                response = self.app.dispatch_request(request)
+        except Exception as e:
+            for index, hook in self.exception_hooks:
+                if index < depth:
+                    _call_sync(hook, request, e)
+            raise
+
+        with span("middleware.process_response"):
+            for index, hook in self.response_hooks:
+                if index < depth:
+                    _call_sync(hook, request, response)
+
+        return response
+
+    async def dispatch_request_async(self, request):
+        depth = len(self.middlewares)
+        response = None
+
+        try:
+            with span("middleware.process_request"):
+                for index, hook in self.request_hooks:
+                    depth = index + 1
+                    response = await _maybe_await(hook(request))
+                    if response is not None:
+                        break
+            if response is None:
+                depth = len(self.middlewares)
+                response = await self.app.dispatch_request_async(request)
+        except Exception as e:
+            for index, hook in self.exception_hooks:
+                if index < depth:
+                    await _maybe_await(hook(request, e))
+            raise
+
+        with span("middleware.process_response"):
+            for index, hook in self.response_hooks:
+                if index < depth:
+                    await _maybe_await(hook(request, response))
+
+        return response
+
+
+class CompressionMiddleware(Middleware):
+    """
+    Gzip/deflate encodes buffered responses above `min_size` bytes whose
+    content type starts with one of `content_types`.
+
+    The last `cache_size` compressed bodies are kept in an LRU keyed by the
+    hash of the uncompressed body, so hot identical responses are not
+    compressed again on every request.
+    """
+
+    encodings = ("gzip", "deflate")
+
+    def __init__(self, app, min_size=500, level=6, content_types=COMPRESSIBLE_CONTENT_TYPES, cache_size=128):
+        super().__init__(app)
+        self.min_size = min_size
+        self.level = level
+        self.content_types = tuple(content_types)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def process_response(self, req, resp):
+        if resp.is_streamed or "Content-Encoding" in resp.headers:
+            return
+
+        body = resp.finalize()
+        content_type = resp.content_type or ""
+        if len(body) < self.min_size or not content_type.startswith(self.content_types):
+            return
+
+        add_vary(resp.headers, "Accept-Encoding")
+
+        accepted = parse_accept_encoding(req.headers.get("Accept-Encoding"))
+        encoding = next((encoding for encoding in self.encodings if encoding in accepted), None)
+        if encoding is None:
+            return
+
+        resp.body = self.compress(body, encoding)
+        resp.headers["Content-Encoding"] = encoding
+
+        # the encoded body is a different representation, so it can only share a weak validator
+        if resp.etag is not None:
+            etag = quote_etag(resp.etag)
+            if not etag.startswith("W/"):
+                resp.etag = f"W/{etag}"
+
+    def compress(self, body, encoding):
+        if self.cache is None:
+            return self._compress(body, encoding)
+
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = self._compress(body, encoding)
+            self.cache.set(key, compressed)
+        return compressed
+
+    def _compress(self, body, encoding):
+        # wbits=31 produces a gzip container, 15 a zlib one (HTTP "deflate")
+        wbits = 31 if encoding == "gzip" else 15
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+        return compressor.compress(body) + compressor.flush()
+
+
+class CachedResponse:
+    __slots__ = ("status_code", "content_type", "headers", "body", "etag", "last_modified", "stored_at", "expires_at")
+
+    def __init__(self, response, ttl):
+        self.status_code = response.status_code
+        self.content_type = response.content_type
+        self.headers = dict(response.headers)
+        self.body = response.body
+        self.etag = response.etag
+        self.last_modified = response.last_modified
+        self.stored_at = time.monotonic()
+        self.expires_at = self.stored_at + ttl
+
+    def restore(self, response):
+        response.status_code = self.status_code
+        response.content_type = self.content_type
+        response.headers.update(self.headers)
+        response.headers["Age"] = str(int(time.monotonic() - self.stored_at))
+        response.body = self.body
+        response.etag = self.etag
+        response.last_modified = self.last_modified
+        return response
+
+
+class CacheMiddleware(Middleware):
+    """
+    Caches finished GET/HEAD responses in memory.
+
+    Entries are keyed by method, path, query string and the values of the
+    `vary` request headers, plus those of any other header named in the
+    response's own `Vary` header (e.g. `Accept-Encoding` added by
+    `CompressionMiddleware`). They expire after `ttl` seconds and are bounded
+    by an LRU of `max_entries`. With `cache_all=False` only routes added with
+    `cache=True` (or `cache=<ttl>`) are cached, otherwise every route is
+    except those added with `cache=False`.
+
+    A cold key is computed by a single request; concurrent requests for the
+    same key wait for it instead of running the handler again.
+    """
+
+    methods = ("GET", "HEAD")
+
+    def __init__(self, app, ttl=60, max_entries=1024, vary=(), cache_all=False):
+        super().__init__(app)
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        self.cache_all = cache_all
+        self.cache = LRUCache(max_entries)
+        # request headers named in the last stored response's Vary, per key
+        self._response_vary = LRUCache(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _get_ttl(self, request):
+        if request.method not in self.methods:
+            return None
+
+        route, _ = self.root_app.find_route(request.path)
+        if route is None or route.cache is False:
+            return None
+        if route.cache is None:
+            return self.ttl if self.cache_all else None
+        if route.cache is True:
+            return self.ttl
+        return route.cache
+
+    def _get_key(self, request):
+        return (
+            request.method,
+            request.path,
+            request.query_string,
+            tuple(request.headers.get(header) for header in self.vary),
+        )
+
+    @staticmethod
+    def _variant_key(request, key, vary):
+        return key + (tuple(request.headers.get(header) for header in vary),)
+
+    def _lookup(self, request, key):
+        key = self._variant_key(request, key, self._response_vary.get(key, ()))
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            self.cache.pop(key)
+            return None
+
+        self.hits += 1
+        response = entry.restore(self.root_app.make_response())
+        response.not_modified(request)
+        return response
+
+    def _store(self, request, key, response, ttl):
+        if response.status_code != 200 or response.is_streamed or "Set-Cookie" in response.headers:
+            return
+
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-store" in cache_control or "private" in cache_control:
+            return
+
+        configured = {header.lower() for header in self.vary}
+        vary = tuple(sorted({
+            header.strip().lower() for header in response.headers.get("Vary", "").split(",")
+            if header.strip() and header.strip().lower() not in configured
+        }))
+        if "*" in vary:
+            return
+
+        response.finalize()
+        self._response_vary.set(key, vary)
+        self.cache.set(self._variant_key(request, key, vary), CachedResponse(response, ttl))
+
+    def _get_lock(self, lock_key, lock_cls):
+        with self._locks_guard:
+            lock = self._locks.get(lock_key)
+            if lock is None:
+                lock = self._locks[lock_key] = lock_cls()
+            return lock
+
+    def _release_lock(self, lock_key, lock):
+        with self._locks_guard:
+            if self._locks.get(lock_key) is lock:
+                del self._locks[lock_key]
+
+    def dispatch_request(self, request):
+        ttl = self._get_ttl(request)
+        if ttl is None:
+            return super().dispatch_request(request)
+
+        key = self._get_key(request)
+        response = self._lookup(request, key)
+        if response is not None:
+            return response
+
+        lock_key = ("sync", key)
+        lock = self._get_lock(lock_key, threading.Lock)
+        with lock:
+            response = self._lookup(request, key)
+            if response is not None:
+                return response
+
+            try:
+                self.misses += 1
+                response = super().dispatch_request(request)
+                self._store(request, key, response, ttl)
+            finally:
+                self._release_lock(lock_key, lock)
+
+        return response
+
+    async def dispatch_request_async(self, request):
+        ttl = self._get_ttl(request)
+        if ttl is None:
+            return await super().dispatch_request_async(request)
+
+        key = self._get_key(request)
+        response = self._lookup(request, key)
+        if response is not None:
+            return response
+
+        lock_key = ("async", key)
+        lock = self._get_lock(lock_key, asyncio.Lock)
+        async with lock:
+            response = self._lookup(request, key)
+            if response is not None:
+                return response
+
+            try:
+                self.misses += 1
+                response = await super().dispatch_request_async(request)
+                self._store(request, key, response, ttl)
+            finally:
+                self._release_lock(lock_key, lock)
+
+        return response
+
+
+class ProfilingMiddleware(Middleware):
+    """
+    Samples the stack of the thread running a request's handler every
+    `interval` seconds and aggregates the collapsed stacks per route pattern,
+    for rendering as flamegraphs.
+
+    A request is profiled when it carries `profile_token(secret, path)` in
+    the `header` header or the `query_param` query parameter, or at random
+    for a `sample_rate` fraction of requests. Requests that are not profiled
+    only pay for these checks.
+
+    Under WSGI the request's thread is sampled while the layers below run.
+    Under ASGI sync handlers are sampled on the thread pool thread running
+    them and async handlers on the event loop, leaving out other requests.
+    """
+
+    def __init__(self, app, output_dir=None, secret=None, header="X-Alcazar-Profile", query_param="_profile",
+                 sample_rate=0.0, interval=0.005):
+        super().__init__(app)
+        self.secret = secret
+        self.header = header
+        self.query_param = query_param
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.stacks = StackAggregator(output_dir)
+
+    def should_profile(self, req):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+
+        if self.secret is None:
+            return False
+
+        token = req.headers.get(self.header) if self.header else None
+        if token is None and self.query_param and self.query_param in req.query_string:
+            token = req.GET.get(self.query_param)
+        if token is None:
+            return False
+
+        # compare bytes, compare_digest refuses str with non-ASCII characters
+        expected = profile_token(self.secret, req.path).encode("ascii")
+        return hmac.compare_digest(token.encode("utf-8", "surrogateescape"), expected)
+
+    def dispatch_request(self, request):
+        if not self.should_profile(request):
+            return super().dispatch_request(request)
+
+        profile = Profile(self.interval)
+        try:
+            # frames above this one belong to the server, not to the request
+            with use_profile(profile), profile.sample(sys._getframe()):
+                return super().dispatch_request(request)
+        finally:
+            self._finish(request, profile)
+
+    async def dispatch_request_async(self, request):
+        if not self.should_profile(request):
+            return await super().dispatch_request_async(request)
+
+        # the event loop thread is shared by all requests, handlers sample the thread they run on
+        profile = Profile(self.interval)
+        try:
+            with use_profile(profile):
+                return await super().dispatch_request_async(request)
+        finally:
+            self._finish(request, profile)
+
+    def _finish(self, req, profile):
+        route, _ = self.root_app.find_route(req.path)
+        label = UNMATCHED_ROUTE if route is None else route.path_pattern
+        self.stacks.add(label, profile.stacks)
@@ -1,67 +1,285 @@
 import inspect
 import sqlite3
+from contextlib import contextmanager
+
+from alcazar.tracing import span
 
 
 class Database:
     def __init__(self, path):
         self.conn = sqlite3.Connection(path)
+        self._transaction_depth = 0
+
+    def execute(self, sql, params=()):
+        with span("sql", statement=sql):
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        with span("sql", statement=sql):
+            return self.conn.executemany(sql, seq_of_params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block in a transaction that is committed when it ends and rolled back if it raises.
+
+        Nested blocks use savepoints, so an inner block can roll back alone. Writes
+        inside the block are committed once, at the end of the outermost one.
+        """
+        depth = self._transaction_depth
+        savepoint = f"alcazar_{depth}"
+
+        if depth == 0:
+            if not self.conn.in_transaction:
+                self.execute("BEGIN")
+        else:
+            self.execute(f"SAVEPOINT {savepoint}")
+
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if depth == 0:
+                self.conn.rollback()
+            else:
+                self.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                self.execute(f"RELEASE SAVEPOINT {savepoint}")
+            raise
+
+        self._transaction_depth -= 1
+        if depth == 0:
+            self.conn.commit()
+        else:
+            self.execute(f"RELEASE SAVEPOINT {savepoint}")
+
+    def _commit(self):
+        if self._transaction_depth == 0:
+            self.conn.commit()
 
     @property
     def tables(self):
         SELECT_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type = 'table';"
-        return [x[0] for x in self.conn.execute(SELECT_TABLES_SQL).fetchall()]
+        return [x[0] for x in self.execute(SELECT_TABLES_SQL).fetchall()]
 
     def create(self, table):
-        self.conn.execute(table._get_create_sql())
+        self.execute(table._get_create_sql())
 
     def save(self, instance):
         sql, values = instance._get_insert_sql()
-        cursor = self.conn.execute(sql, values)
+        cursor = self.execute(sql, values)
         instance._data['id'] = cursor.lastrowid
-        self.conn.commit()
+        self._commit()
 
-    def all(self, table):
-        sql, fields = table._get_select_all_sql()
+    def bulk_save(self, instances):
+        """ Insert many instances with one statement per table and a single commit, setting their ids """
+        with self.transaction():
+            for table, group in _group_by_table(instances):
+                sql, _ = group[0]._get_insert_sql()
+                self.executemany(sql, (instance._get_values() for instance in group))
+
+                # the rows of one statement get consecutive ids while the transaction holds the write lock
+                last_id = self.execute("SELECT last_insert_rowid();").fetchone()[0]
+                for id, instance in enumerate(group, start=last_id - len(group) + 1):
+                    instance._data['id'] = id
+
+    def all(self, table, related="prefetch"):
+        """
+        Fetch every row of `table`.
+
+        `related` selects how foreign keys are loaded: `prefetch` runs one
+        `WHERE id IN (...)` query per foreign key, `join` fetches them in the
+        same query with a LEFT JOIN and `lazy` loads each one on first access.
+        """
+        assert related in RELATED_STRATEGIES, f"Unknown related strategy: {related}"
 
-        result = []
-        for row in self.conn.execute(sql).fetchall():
-            instance = table()
-            for field, value in zip(fields, row):
-                if field.endswith('_id'):
-                    field = field[:-3]
-                    fk = getattr(table, field)
-                    value = self.get(fk.table, id=value)
-                setattr(instance, field, value)
-            result.append(instance)
+        if related == "join":
+            return self._load_joined(table, self.execute(table._sql["select_all_join"]).fetchall())
 
-        return result
+        sql, fields = table._get_select_all_sql()
+        return self._load(table, self.execute(sql).fetchall(), related)
+
+    def get(self, table, id, related="prefetch"):
+        assert related in RELATED_STRATEGIES, f"Unknown related strategy: {related}"
 
-    def get(self, table, id):
-        sql, fields, params = table._get_select_where_sql(id=id)
+        if related == "join":
+            instances = self._load_joined(table, self.execute(table._sql["select_where_join"], [id]).fetchall())
+        else:
+            sql, fields, params = table._get_select_where_sql(id=id)
+            instances = self._load(table, self.execute(sql, params).fetchall(), related)
 
-        row = self.conn.execute(sql, params).fetchone()
-        if row is None:
+        if not instances:
             raise Exception(f"{table.__name__} instance with id {id} does not exist")
 
+        return instances[0]
+
+    def iterate(self, table, chunk_size=1000, related="prefetch"):
+        """
+        Yield every row of `table`, fetching `chunk_size` rows at a time.
+
+        Unlike `all`, only one chunk is held in memory, so the generator can
+        feed a streaming response. Foreign keys are loaded per chunk.
+        """
+        assert related in RELATED_STRATEGIES, f"Unknown related strategy: {related}"
+
+        if related == "join":
+            cursor = self.execute(table._sql["select_all_join"])
+        else:
+            cursor = self.execute(table._get_select_all_sql()[0])
+
+        return self._iterate(table, cursor, related, chunk_size)
+
+    def _iterate(self, table, cursor, related, chunk_size):
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+
+                if related == "join":
+                    yield from self._load_joined(table, rows)
+                else:
+                    yield from self._load(table, rows, related)
+        finally:
+            cursor.close()
+
+    def query(self, table):
+        """ A lazy, chainable query on `table`, run when it is iterated """
+        return Query(self, table)
+
+    def _build_instance(self, table, row):
+        """ An instance with its foreign keys still holding the raw ids """
         instance = table()
-        for field, value in zip(fields, row):
-            if field.endswith('_id'):
-                field = field[:-3]
-                fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
-            setattr(instance, field, value)
+        for (field, name, fk), value in zip(table._select_columns, row):
+            setattr(instance, name, value)
 
         return instance
 
+    def _load(self, table, rows, related):
+        instances = [self._build_instance(table, row) for row in rows]
+        self._load_related(table, instances, related)
+        return instances
+
+    def _load_related(self, table, instances, related):
+        for field, name, fk in table._columns:
+            if fk is None:
+                continue
+
+            if related == "lazy":
+                for instance in instances:
+                    id = _get_raw(instance, name)
+                    setattr(instance, name, None if id is None else LazyRelation(self, fk.table, id))
+                continue
+
+            ids = {_get_raw(instance, name) for instance in instances}
+            ids.discard(None)
+            objects = {obj.id: obj for obj in self._get_many(fk.table, ids)}
+
+            for instance in instances:
+                id = _get_raw(instance, name)
+                if id is not None and id not in objects:
+                    raise Exception(f"{fk.table.__name__} instance with id {id} does not exist")
+                setattr(instance, name, objects.get(id))
+
+    def _get_many(self, table, ids):
+        ids = sorted(ids)
+        instances = []
+        # stay below SQLite's limit on the number of parameters
+        for start in range(0, len(ids), 500):
+            sql, fields, params = table._get_select_in_sql(ids[start:start + 500])
+            instances.extend(self._load(table, self.execute(sql, params).fetchall(), "prefetch"))
+        return instances
+
+    def _load_joined(self, table, rows):
+        width = len(table._select_columns)
+        objects = {}
+        nested = {}
+
+        instances = []
+        for row in rows:
+            instance = self._build_instance(table, row[:width])
+            offset = width
+
+            for field, name, fk in table._columns:
+                if fk is None:
+                    continue
+
+                related_width = len(fk.table._select_columns)
+                related_row = row[offset:offset + related_width]
+                offset += related_width
+
+                id = _get_raw(instance, name)
+                if id is None:
+                    continue
+                if related_row[0] is None:
+                    raise Exception(f"{fk.table.__name__} instance with id {id} does not exist")
+
+                obj = objects.get((fk.table, id))
+                if obj is None:
+                    obj = objects[(fk.table, id)] = self._build_instance(fk.table, related_row)
+                    nested.setdefault(fk.table, []).append(obj)
+                setattr(instance, name, obj)
+
+            instances.append(instance)
+
+        # foreign keys of the joined rows are prefetched
+        for related_table, related_instances in nested.items():
+            self._load_related(related_table, related_instances, "prefetch")
+
+        return instances
+
     def update(self, instance):
         sql, values = instance._get_update_sql()
-        self.conn.execute(sql, values)
-        self.conn.commit()
+        self.execute(sql, values)
+        self._commit()
+
+    def bulk_update(self, instances):
+        with self.transaction():
+            for table, group in _group_by_table(instances):
+                sql, _ = group[0]._get_update_sql()
+                self.executemany(sql, (instance._get_update_sql()[1] for instance in group))
 
     def delete(self, table, id):
         sql, params = table._get_delete_sql(id)
-        self.conn.execute(sql, params)
-        self.conn.commit()
+        self.execute(sql, params)
+        self._commit()
+
+    def bulk_delete(self, table, ids):
+        sql, _ = table._get_delete_sql(None)
+        with self.transaction():
+            self.executemany(sql, ([id] for id in ids))
+
+
+RELATED_STRATEGIES = ("prefetch", "join", "lazy")
+
+
+def _group_by_table(instances):
+    groups = {}
+    for instance in instances:
+        groups.setdefault(type(instance), []).append(instance)
+    return groups.items()
+
+
+def _get_raw(instance, key):
+    """ Attribute of a table instance without loading a lazy relation """
+    _data = object.__getattribute__(instance, '_data')
+    if key in _data:
+        return _data[key]
+    return object.__getattribute__(instance, key)
+
+
+class LazyRelation:
+    """ Placeholder for a foreign key that is fetched on first access """
+
+    __slots__ = ("db", "table", "id")
+
+    def __init__(self, db, table, id):
+        self.db = db
+        self.table = table
+        self.id = id
+
+    def load(self):
+        return self.db.get(self.table, id=self.id, related="lazy")
 
 
 class Table:
@@ -74,117 +292,292 @@ class Table:
             self._data[key] = value
 
     def __getattribute__(self, key):
-        _data = super().__getattribute__('_data')
-        if key in _data:
-            return _data[key]
-        return super().__getattribute__(key)
+        value = _get_raw(self, key)
+        if type(value) is LazyRelation:
+            value = value.load()
+            setattr(self, key, value)
+        return value
 
     def __setattr__(self, key, value):
         super().__setattr__(key, value)
         if key in self._data:
             self._data[key] = value
 
-    @classmethod
-    def _get_create_sql(cls):
-        CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
-        fields = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT",
-        ]
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
 
+        # collect the columns once per class, in the alphabetical order `inspect.getmembers` used
+        cls._columns = []
         for name, field in inspect.getmembers(cls):
             if isinstance(field, Column):
-                fields.append(f"{name} {field.sql_type}")
+                cls._columns.append((name, name, None))
             elif isinstance(field, ForeignKey):
-                fields.append(f"{name}_id INTEGER")
+                cls._columns.append((f"{name}_id", name, field))
 
-        fields = ", ".join(fields)
-        name = cls.__name__.lower()
-        return CREATE_TABLE_SQL.format(name=name, fields=fields)
+        cls._select_columns = [("id", "id", None)] + cls._columns
+        cls._select_fields = [field for field, _, _ in cls._select_columns]
+        cls._build_sql()
 
-    def _get_insert_sql(self):
+    @classmethod
+    def _build_sql(cls):
+        CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
         INSERT_SQL = 'INSERT INTO {name} ({fields}) VALUES ({placeholders});'
-        cls = self.__class__
-        fields = []
-        placeholders = []
-        values = []
+        SELECT_SQL = 'SELECT {fields} FROM {name}'
+        SELECT_ALL_SQL = 'SELECT {fields} FROM {name};'
+        SELECT_WHERE_SQL = 'SELECT {fields} FROM {name} WHERE id = ?;'
+        SELECT_IN_SQL = 'SELECT {fields} FROM {name} WHERE id IN ({{placeholders}});'
+        SELECT_JOIN_SQL = 'SELECT {fields} FROM {name} {joins}'
+        UPDATE_SQL = 'UPDATE {name} SET {fields} WHERE id = ?'
+        DELETE_SQL = 'DELETE FROM {name} WHERE id = ?'
 
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-                placeholders.append('?')
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
-                placeholders.append('?')
+        name = cls.__name__.lower()
+        fields = [field for field, _, _ in cls._columns]
+        select_fields = ", ".join(field for field, _, _ in cls._select_columns)
+
+        join_fields = [f"{name}.{field}" for field, _, _ in cls._select_columns]
+        joins = []
+        for index, (field, _, fk) in enumerate(column for column in cls._columns if column[2] is not None):
+            alias = f"t{index}"
+            join_fields.extend(f"{alias}.{related_field}" for related_field, _, _ in fk.table._select_columns)
+            joins.append(f"LEFT JOIN {fk.table.__name__.lower()} AS {alias} ON {alias}.id = {name}.{field}")
+        select_join = SELECT_JOIN_SQL.format(name=name, fields=", ".join(join_fields), joins=" ".join(joins)).strip()
+
+        create_fields = ["id INTEGER PRIMARY KEY AUTOINCREMENT"]
+        for field, attr, fk in cls._columns:
+            sql_type = "INTEGER" if fk is not None else getattr(cls, attr).sql_type
+            create_fields.append(f"{field} {sql_type}")
+
+        cls._sql = {
+            "create": CREATE_TABLE_SQL.format(name=name, fields=", ".join(create_fields)),
+            "insert": INSERT_SQL.format(
+                name=name, fields=", ".join(fields), placeholders=", ".join("?" for _ in fields),
+            ),
+            "select": SELECT_SQL.format(name=name, fields=select_fields),
+            "select_all": SELECT_ALL_SQL.format(name=name, fields=select_fields),
+            "select_where": SELECT_WHERE_SQL.format(name=name, fields=select_fields),
+            "select_in": SELECT_IN_SQL.format(name=name, fields=select_fields),
+            "select_join": select_join,
+            "select_all_join": f"{select_join};",
+            "select_where_join": f"{select_join} WHERE {name}.id = ?;",
+            "update": UPDATE_SQL.format(name=name, fields=", ".join(f"{field} = ?" for field in fields)),
+            "delete": DELETE_SQL.format(name=name),
+        }
 
-        fields = ", ".join(fields)
-        placeholders = ", ".join(placeholders)
+    def to_dict(self):
+        """ The instance's fields, with foreign keys as ids, e.g. to send it as JSON """
+        data = {"id": _get_raw(self, "id")}
+        for field, name, fk in self._columns:
+            value = _get_raw(self, name)
+            if fk is not None:
+                data[field] = _to_id(value)
+            else:
+                data[name] = value
+        return data
+
+    def _get_values(self):
+        values = []
+        for field, name, fk in self._columns:
+            value = _get_raw(self, name)
+            if fk is not None and value is not None:
+                value = value.id
+            values.append(value)
+        return values
 
-        sql = INSERT_SQL.format(name=cls.__name__.lower(), fields=fields, placeholders=placeholders)
+    @classmethod
+    def _get_create_sql(cls):
+        return cls._sql["create"]
 
-        return sql, values
+    def _get_insert_sql(self):
+        return self._sql["insert"], self._get_values()
 
     @classmethod
     def _get_select_all_sql(cls):
-        SELECT_ALL_SQL = 'SELECT {fields} FROM {name};'
-
-        fields = ['id']
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-            if isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-
-        sql = SELECT_ALL_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
-
-        return sql, fields
+        return cls._sql["select_all"], cls._select_fields
 
     @classmethod
     def _get_select_where_sql(cls, id):
-        SELECT_WHERE_SQL = 'SELECT {fields} FROM {name} WHERE id = ?;'
-        fields = ['id']
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-            if isinstance(field, ForeignKey):
-                fields.append(name + '_id')
-
-        sql = SELECT_WHERE_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
-        params = [id]
+        return cls._sql["select_where"], cls._select_fields, [id]
 
-        return sql, fields, params
+    @classmethod
+    def _get_select_in_sql(cls, ids):
+        sql = cls._sql["select_in"].format(placeholders=", ".join("?" for _ in ids))
+        return sql, cls._select_fields, list(ids)
 
     def _get_update_sql(self):
-        UPDATE_SQL = 'UPDATE {name} SET {fields} WHERE id = ?'
-        cls = self.__class__
-        fields = []
-        values = []
-
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
-
+        values = self._get_values()
         values.append(getattr(self, 'id'))
 
-        sql = UPDATE_SQL.format(
-            name=cls.__name__.lower(),
-            fields=', '.join([f"{field} = ?" for field in fields])
-        )
-
-        return sql, values
+        return self._sql["update"], values
 
     @classmethod
     def _get_delete_sql(cls, id):
-        DELETE_SQL = 'DELETE FROM {name} WHERE id = ?'
-
-        sql = DELETE_SQL.format(name=cls.__name__.lower())
-
-        return sql, [id]
+        return cls._sql["delete"], [id]
+
+
+class Query:
+    """
+    A SELECT built up by chaining `filter`, `order_by`, `limit` and `offset`.
+
+    Every call returns a new query, and nothing runs until the query is
+    iterated or `all`/`first` is called, which execute a single
+    parameterized statement.
+    """
+
+    OPERATORS = {
+        "exact": "=",
+        "ne": "!=",
+        "lt": "<",
+        "lte": "<=",
+        "gt": ">",
+        "gte": ">=",
+        "in": "IN",
+    }
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self._where = []
+        self._params = []
+        self._order_by = []
+        self._limit = None
+        self._offset = None
+        self._related = "prefetch"
+
+    def _clone(self):
+        query = Query(self.db, self.table)
+        query._where = list(self._where)
+        query._params = list(self._params)
+        query._order_by = list(self._order_by)
+        query._limit = self._limit
+        query._offset = self._offset
+        query._related = self._related
+        return query
+
+    def _column(self, name):
+        """ Qualified column of a field name, and the foreign key it refers to, if any """
+        if name == "id":
+            return f"{self.table.__name__.lower()}.id", None
+
+        for field, attr, fk in self.table._columns:
+            if attr == name or field == name:
+                return f"{self.table.__name__.lower()}.{field}", fk
+
+        raise AssertionError(f"{self.table.__name__} has no field {name}")
+
+    def filter(self, **conditions):
+        """
+        Keep the rows matching all `conditions`, given as `field=value` or
+        `field__<op>=value` with op one of exact, ne, lt, lte, gt, gte and in.
+
+        Foreign keys can be compared to instances or ids (`author=greg`) or
+        filtered on the related table's fields (`author__name="George"`).
+        """
+        query = self._clone()
+        for lookup, value in conditions.items():
+            sql, params = query._compile_condition(lookup.split("__"), value)
+            query._where.append(sql)
+            query._params.extend(params)
+        return query
+
+    def _compile_condition(self, parts, value):
+        column, fk = self._column(parts[0])
+
+        if fk is not None and len(parts) > 1 and parts[1] not in self.OPERATORS:
+            # a lookup on the related table becomes a subquery on it
+            related_sql, params = Query(self.db, fk.table).filter(**{"__".join(parts[1:]): value})._get_sql(
+                fields=f"{fk.table.__name__.lower()}.id",
+            )
+            return f"{column} IN ({related_sql})", params
+
+        assert len(parts) <= 2 and (len(parts) == 1 or parts[1] in self.OPERATORS), \
+            f"Unsupported lookup: {'__'.join(parts)}"
+        operator = self.OPERATORS[parts[1] if len(parts) == 2 else "exact"]
+
+        if operator == "IN":
+            values = [_to_id(item) if fk is not None else item for item in value]
+            if not values:
+                return "0", []
+            return f"{column} IN ({', '.join('?' for _ in values)})", values
+
+        if fk is not None:
+            value = _to_id(value)
+
+        if value is None and operator in ("=", "!="):
+            return f"{column} IS {'NOT ' if operator == '!=' else ''}NULL", []
+
+        return f"{column} {operator} ?", [value]
+
+    def order_by(self, *fields):
+        """ Sort by `fields`, descending for names prefixed with `-` """
+        query = self._clone()
+        for name in fields:
+            descending = name.startswith("-")
+            column, _ = self._column(name.lstrip("-"))
+            query._order_by.append(f"{column} DESC" if descending else column)
+        return query
+
+    def limit(self, limit):
+        query = self._clone()
+        query._limit = limit
+        return query
+
+    def offset(self, offset):
+        query = self._clone()
+        query._offset = offset
+        return query
+
+    def related(self, strategy):
+        """ How foreign keys of the results are loaded, as in `Database.all` """
+        assert strategy in RELATED_STRATEGIES, f"Unknown related strategy: {strategy}"
+        query = self._clone()
+        query._related = strategy
+        return query
+
+    def _get_sql(self, fields=None):
+        if fields is not None:
+            sql = f"SELECT {fields} FROM {self.table.__name__.lower()}"
+        elif self._related == "join":
+            sql = self.table._sql["select_join"]
+        else:
+            sql = self.table._sql["select"]
+        params = list(self._params)
+
+        if self._where:
+            sql += " WHERE " + " AND ".join(self._where)
+        if self._order_by:
+            sql += " ORDER BY " + ", ".join(self._order_by)
+        if self._limit is not None or self._offset is not None:
+            sql += " LIMIT ?"
+            params.append(-1 if self._limit is None else self._limit)
+        if self._offset is not None:
+            sql += " OFFSET ?"
+            params.append(self._offset)
+
+        return sql, params
+
+    def all(self):
+        sql, params = self._get_sql()
+        rows = self.db.execute(sql, params).fetchall()
+
+        if self._related == "join":
+            return self.db._load_joined(self.table, rows)
+        return self.db._load(self.table, rows, self._related)
+
+    def iterate(self, chunk_size=1000):
+        """ Yield the results `chunk_size` rows at a time instead of loading them all, as `Database.iterate` """
+        sql, params = self._get_sql()
+        return self.db._iterate(self.table, self.db.execute(sql, params), self._related, chunk_size)
+
+    def first(self):
+        results = self.limit(1).all()
+        return results[0] if results else None
+
+    def __iter__(self):
+        return iter(self.all())
+
+
+def _to_id(value):
+    return value.id if isinstance(value, (Table, LazyRelation)) else value
 
 
 class Column:
@@ -0,0 +1,157 @@
+import contextvars
+import hashlib
+import hmac
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+_current_profile = contextvars.ContextVar("alcazar_current_profile", default=None)
+
+
+def profile_token(secret, path):
+    """ Signature that enables profiling of `path` through the profiling header or query parameter """
+    return hmac.new(secret.encode("UTF-8"), path.encode("UTF-8"), hashlib.sha256).hexdigest()
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, root=None):
+    """
+    Collapse the stack ending at `frame` into `outer;...;inner`, leaving out
+    `root` and its callers. Stacks that do not run under `root`, such as
+    other tasks of an event loop, collapse to an empty string.
+    """
+    names = []
+    while frame is not None and frame is not root:
+        names.append(format_frame(frame))
+        frame = frame.f_back
+
+    if frame is None and root is not None:
+        return ""
+
+    names.reverse()
+    return ";".join(names)
+
+
+def format_collapsed(stacks):
+    """ Stacks in the collapsed format read by flamegraph.pl and speedscope """
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def stacks_filename(label):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") or "root"
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread every `interval` seconds from a background
+    thread, counting identical collapsed stacks.
+    """
+
+    def __init__(self, thread_id, root=None, interval=0.005):
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="alcazar-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = collapse_stack(frame, self.root)
+            if stack:
+                self.stacks[stack] += 1
+
+
+class StackAggregator:
+    """ Collapsed stacks per route pattern, optionally written to `<output_dir>/<route>.folded` """
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.stacks = {}
+        self._lock = threading.Lock()
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, label, stacks):
+        with self._lock:
+            total = self.stacks.setdefault(label, Counter())
+            total.update(stacks)
+            if self.output_dir is not None:
+                self._write(label, total)
+
+    def collapsed(self, label):
+        with self._lock:
+            return format_collapsed(self.stacks.get(label, {}))
+
+    def _write(self, label, stacks):
+        path = os.path.join(self.output_dir, f"{stacks_filename(label)}.folded")
+        with open(path, "w") as f:
+            f.write(format_collapsed(stacks))
+
+
+class Profile:
+    """ Stacks sampled while handling one request, possibly on several threads """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def sample(self, root):
+        """ Sample the calling thread inside the block, keeping the frames below `root` """
+        sampler = StackSampler(threading.get_ident(), root=root, interval=self.interval).start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            with self._lock:
+                self.stacks.update(stacks)
+
+    def run(self, func, *args, **kwargs):
+        """ Call `func` while sampling the calling thread, e.g. in a thread pool """
+        with self.sample(sys._getframe()):
+            return func(*args, **kwargs)
+
+
+def current_profile():
+    """ The profile of the current request, or None when it is not profiled """
+    return _current_profile.get()
+
+
+def sample_current_thread(root):
+    """ `Profile.sample` of the current request's profile, or a no-op when it is not profiled """
+    profile = _current_profile.get()
+    if profile is None:
+        return nullcontext()
+    return profile.sample(root)
+
+
+@contextmanager
+def use_profile(profile):
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
@@ -1,4 +1,203 @@
+import io
+import json
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl, quote
+
 from webob import Request as WebObRequest
+from webob.headers import EnvironHeaders
+from webob.multidict import MultiDict, NestedMultiDict
+
+
+_NOT_LOADED = object()
+
+# characters WebOb leaves unquoted in paths
+PATH_SAFE = "/~!$&'()*+,;=:@"
+
+
+class Request:
+    """
+    Lightweight request that parses the query string, headers, cookies and
+    body only when they are first accessed.
+
+    It implements the commonly used subset of the WebOb request API. Any
+    other attribute is looked up on a `webob.Request` built on demand, and
+    ad-hoc attributes are stored in the environ as WebOb does.
+    """
+
+    __slots__ = ("environ", "_GET", "_POST", "_headers", "_cookies", "_body", "_webob")
+
+    def __init__(self, environ):
+        self.environ = environ
+        self._GET = _NOT_LOADED
+        self._POST = _NOT_LOADED
+        self._headers = _NOT_LOADED
+        self._cookies = _NOT_LOADED
+        self._body = _NOT_LOADED
+        self._webob = None
+
+    @property
+    def method(self):
+        return self.environ.get("REQUEST_METHOD", "GET")
+
+    def _environ_bytes(self, key):
+        # PEP 3333 passes the raw bytes of the path as latin-1 strings
+        return self.environ.get(key, "").encode("latin-1")
+
+    @property
+    def script_name(self):
+        return self._environ_bytes("SCRIPT_NAME").decode("utf-8")
+
+    @property
+    def path_info(self):
+        return self._environ_bytes("PATH_INFO").decode("utf-8")
+
+    @property
+    def path(self):
+        """ URL-quoted script name and path info, as WebOb returns it """
+        return (
+            quote(self._environ_bytes("SCRIPT_NAME"), PATH_SAFE)
+            + quote(self._environ_bytes("PATH_INFO"), PATH_SAFE)
+        )
+
+    @property
+    def query_string(self):
+        return self.environ.get("QUERY_STRING", "")
+
+    @property
+    def scheme(self):
+        return self.environ.get("wsgi.url_scheme", "http")
+
+    @property
+    def host(self):
+        host = self.environ.get("HTTP_HOST")
+        if host is not None:
+            return host
+
+        host = self.environ.get("SERVER_NAME", "localhost")
+        port = self.environ.get("SERVER_PORT")
+        if port and port != ("443" if self.scheme == "https" else "80"):
+            host = f"{host}:{port}"
+        return host
+
+    @property
+    def host_url(self):
+        return f"{self.scheme}://{self.host}"
+
+    @property
+    def application_url(self):
+        return self.host_url + quote(self._environ_bytes("SCRIPT_NAME"), PATH_SAFE)
+
+    @property
+    def path_url(self):
+        return self.host_url + self.path
+
+    @property
+    def url(self):
+        url = self.path_url
+        if self.query_string:
+            url = f"{url}?{self.query_string}"
+        return url
+
+    @property
+    def remote_addr(self):
+        return self.environ.get("REMOTE_ADDR")
+
+    @property
+    def content_type(self):
+        return self.environ.get("CONTENT_TYPE", "").split(";", 1)[0].strip()
+
+    @property
+    def content_length(self):
+        value = self.environ.get("CONTENT_LENGTH")
+        return int(value) if value else None
+
+    @property
+    def headers(self):
+        if self._headers is _NOT_LOADED:
+            self._headers = EnvironHeaders(self.environ)
+        return self._headers
+
+    @property
+    def GET(self):
+        if self._GET is _NOT_LOADED:
+            self._GET = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+        return self._GET
+
+    @property
+    def POST(self):
+        if self._POST is _NOT_LOADED:
+            if self.method not in ("POST", "PUT", "PATCH", "DELETE"):
+                self._POST = MultiDict()
+            elif self.content_type == "application/x-www-form-urlencoded":
+                self._POST = MultiDict(parse_qsl(self.text, keep_blank_values=True))
+            elif self.content_type.startswith("multipart/"):
+                # buffer the body first so it stays readable after WebOb parses it
+                self.body
+                self._POST = self._get_webob().POST
+            else:
+                self._POST = MultiDict()
+        return self._POST
+
+    @property
+    def params(self):
+        return NestedMultiDict(self.GET, self.POST)
+
+    @property
+    def cookies(self):
+        if self._cookies is _NOT_LOADED:
+            cookie = SimpleCookie()
+            cookie.load(self.environ.get("HTTP_COOKIE", ""))
+            self._cookies = {name: morsel.value for name, morsel in cookie.items()}
+        return self._cookies
+
+    @property
+    def body(self):
+        if self._body is _NOT_LOADED:
+            length = self.content_length
+            stream = self.environ.get("wsgi.input")
+            if not length or stream is None:
+                self._body = b""
+            else:
+                self._body = stream.read(length)
+                # let anything reading the environ afterwards see the body again
+                self.environ["wsgi.input"] = io.BytesIO(self._body)
+        return self._body
+
+    @property
+    def text(self):
+        return self.body.decode("UTF-8")
+
+    @property
+    def json(self):
+        return json.loads(self.body)
+
+    def _get_webob(self):
+        if self._webob is None:
+            self._webob = WebObRequest(self.environ)
+        return self._webob
+
+    def __getattr__(self, name):
+        adhoc_attrs = self.environ.get("webob.adhoc_attrs")
+        if adhoc_attrs is not None and name in adhoc_attrs:
+            return adhoc_attrs[name]
+
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._get_webob(), name)
+
+    def __setattr__(self, name, value):
+        # like WebOb, keep ad-hoc attributes (`req.user = ...`) in the environ
+        if hasattr(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            self.environ.setdefault("webob.adhoc_attrs", {})[name] = value
+
+    def __delattr__(self, name):
+        if hasattr(type(self), name):
+            object.__delattr__(self, name)
+            return
 
-# temporary alias
-Request = WebObRequest
+        try:
+            del self.environ["webob.adhoc_attrs"][name]
+        except KeyError:
+            raise AttributeError(name)
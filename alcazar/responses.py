@@ -1,20 +1,99 @@
-import json
+import asyncio
+import contextvars
+import functools
+import mimetypes
+import os
+from http import HTTPStatus
 
 from webob import Response as WebObResponse
 
+from alcazar.encoders import default_json_encoder
+from alcazar.utils.asgi import encode_headers, send_body
+from alcazar.utils.conditional import quote_etag, etag_matches, format_http_date, not_modified_since
+from alcazar.utils.files import get_file_size, parse_range_header, iter_file
+
+
+_STATUS_CLASS_PHRASES = {
+    1: "Informational",
+    2: "Success",
+    3: "Redirection",
+    4: "Client Error",
+    5: "Server Error",
+}
+
+NO_BODY_STATUSES = frozenset({204, 304})
+
+STATUS_LINES = {status.value: f"{status.value} {status.phrase}" for status in HTTPStatus}
+
+
+def status_line(status_code):
+    try:
+        return STATUS_LINES[status_code]
+    except KeyError:
+        return f"{status_code} {_STATUS_CLASS_PHRASES.get(status_code // 100, 'Unknown')}"
+
+
+def encode_chunks(chunks, encoding="UTF-8"):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(encoding)
+        if chunk:
+            yield chunk
+
+
+async def aencode_chunks(chunks, encoding="UTF-8"):
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(encoding)
+        if chunk:
+            yield chunk
+
 
 class Response:
-    def __init__(self):
+    __slots__ = (
+        "json", "html", "text", "content_type", "body", "stream", "status_code", "headers", "json_encoder", "etag",
+        "last_modified", "_file", "_auto_etag",
+    )
+
+    def __init__(self, json_encoder=None):
         self.json = None
         self.html = None
         self.text = None
         self.content_type = None
         self.body = None
+        self.stream = None
         self.status_code = 200
+        self.headers = {}
+        self.json_encoder = json_encoder or default_json_encoder
+        self.etag = None
+        self.last_modified = None
+        self._file = None
+        # the route's `etag` setting, None follows the app's
+        self._auto_etag = None
+
+    def stream_json(self, items):
+        """ Send an iterable as a JSON array, encoding it item by item """
+        self.stream = self.json_encoder.iter_list(items)
+        self.content_type = "application/json"
+
+    def file(self, path_or_fileobj, content_type=None):
+        """ Send a file from disk, letting the server use sendfile when it can """
+        if isinstance(path_or_fileobj, (str, bytes, os.PathLike)):
+            fileobj = open(path_or_fileobj, "rb")
+        else:
+            fileobj = path_or_fileobj
+
+        if content_type is None:
+            name = getattr(fileobj, "name", None)
+            if isinstance(name, str):
+                content_type = mimetypes.guess_type(name)[0]
+
+        self._file = fileobj
+        self.content_type = content_type or "application/octet-stream"
 
     def set_body_and_content_type(self):
         if self.json is not None:
-            self.body = json.dumps(self.json, separators=(',', ':')).encode('UTF-8')
+            self.body = self.json_encoder.dumps(self.json)
             self.content_type = "application/json"
 
         if self.html is not None:
@@ -25,10 +104,169 @@ class Response:
             self.body = self.text
             self.content_type = "text/plain"
 
-        assert self.body, "No content found."
+        if self._file is not None:
+            return
 
-    def __call__(self, environ, start_response):
+        if self.stream is not None:
+            if self.content_type is None:
+                self.content_type = "text/plain"
+            return
+
+        assert self.body or self.status_code in NO_BODY_STATUSES, "No content found."
+
+    def not_modified(self, req):
+        """
+        Check the request's conditional headers against `etag` and `last_modified`.
+
+        On a match the response becomes a bodyless 304 and True is returned, so
+        handlers can set their validators first and skip rendering entirely.
+        """
+        if req.method not in ("GET", "HEAD"):
+            return False
+
+        if_none_match = req.headers.get("If-None-Match")
+        if if_none_match is not None:
+            matched = self.etag is not None and etag_matches(self.etag, if_none_match)
+        else:
+            if_modified_since = req.headers.get("If-Modified-Since")
+            matched = (
+                self.last_modified is not None and if_modified_since is not None
+                and not_modified_since(self.last_modified, if_modified_since)
+            )
+
+        if matched:
+            self.status_code = 304
+            self.json = self.html = self.text = self.body = self.stream = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        return matched
+
+    @property
+    def is_streamed(self):
+        return self.stream is not None or self._file is not None
+
+    def finalize(self):
+        """ Render json/html/text into `body` bytes, so middleware can inspect or replace the final body """
+        assert not self.is_streamed, "Streamed responses have no final body."
+
+        self.set_body_and_content_type()
+        self.json = self.html = self.text = None
+        if isinstance(self.body, str):
+            self.body = self.body.encode("UTF-8")
+        elif self.body is None:
+            self.body = b""
+
+        return self.body
+
+    def _headerlist(self, content_length=None):
+        headerlist = []
+
+        content_type = self.content_type
+        if content_type is not None:
+            if content_type.startswith("text/") and "charset=" not in content_type:
+                content_type = f"{content_type}; charset=UTF-8"
+            headerlist.append(("Content-Type", content_type))
+
+        if content_length is not None:
+            headerlist.append(("Content-Length", str(content_length)))
+
+        if self.etag is not None:
+            headerlist.append(("ETag", quote_etag(self.etag)))
+
+        if self.last_modified is not None:
+            headerlist.append(("Last-Modified", format_http_date(self.last_modified)))
+
+        headerlist.extend(self.headers.items())
+        return headerlist
+
+    def _render_file(self, environ):
+        size = get_file_size(self._file)
+        self.headers["Accept-Ranges"] = "bytes"
+
+        try:
+            byte_range = parse_range_header(environ.get("HTTP_RANGE"), size)
+        except ValueError:
+            self._file.close()
+            self.headers["Content-Range"] = f"bytes */{size}"
+            return 416, self._headerlist(content_length=0), []
+
+        if byte_range is None:
+            file_wrapper = environ.get("wsgi.file_wrapper")
+            if file_wrapper is not None:
+                self._file.seek(0)
+                app_iter = file_wrapper(self._file, 64 * 1024)
+            else:
+                app_iter = iter_file(self._file)
+            return self.status_code, self._headerlist(content_length=size), app_iter
+
+        start, end = byte_range
+        length = end - start + 1
+        self.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        app_iter = iter_file(self._file, start=start, length=length)
+        return 206, self._headerlist(content_length=length), app_iter
+
+    def render(self, environ):
+        """ Return the status code, header list and body iterable of the response """
         self.set_body_and_content_type()
 
-        response = WebObResponse(body=self.body, content_type=self.content_type, status=self.status_code)
-        return response(environ, start_response)
+        if self.status_code in NO_BODY_STATUSES:
+            self.content_type = None
+            status_code, headerlist, app_iter = self.status_code, self._headerlist(), []
+        elif self._file is not None:
+            status_code, headerlist, app_iter = self._render_file(environ)
+        elif self.stream is not None:
+            if hasattr(self.stream, "__aiter__"):
+                app_iter = aencode_chunks(self.stream)
+            else:
+                app_iter = encode_chunks(self.stream)
+            status_code, headerlist = self.status_code, self._headerlist()
+        else:
+            body = self.body
+            if isinstance(body, str):
+                body = body.encode("UTF-8")
+            status_code, headerlist, app_iter = self.status_code, self._headerlist(content_length=len(body)), [body]
+
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            app_iter = []
+
+        return status_code, headerlist, app_iter
+
+    def __call__(self, environ, start_response):
+        status_code, headerlist, app_iter = self.render(environ)
+        assert not hasattr(app_iter, "__aiter__"), "Async streams are only supported under ASGI."
+
+        start_response(status_line(status_code), headerlist)
+        return app_iter
+
+    async def asgi(self, environ, send, run_sync=None):
+        """ Send the response over ASGI. Sync bodies are pulled with `run_sync`, the app's thread pool """
+        status_code, headerlist, app_iter = self.render(environ)
+
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": encode_headers(headerlist),
+        })
+        await send_body(send, app_iter, run_sync or _run_in_default_executor)
+
+
+async def _run_in_default_executor(func, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, func, *args))
+
+
+class WebObCompatResponse(Response):
+    """ Response that is sent through a full `webob.Response`, as before the fast path existed """
+
+    __slots__ = ()
+
+    def to_webob(self, environ):
+        status_code, headerlist, app_iter = self.render(environ)
+        return WebObResponse(status=status_line(status_code), headerlist=headerlist, app_iter=app_iter)
+
+    def __call__(self, environ, start_response):
+        return self.to_webob(environ)(environ, start_response)
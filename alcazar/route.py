@@ -1,37 +1,86 @@
 import inspect
 from http import HTTPStatus
 
-from parse import parse
+from parse import compile as compile_pattern
 
 from alcazar.constants import ALL_HTTP_METHODS
 from alcazar.exceptions import HTTPError
 
 
 class Route:
-    def __init__(self, path_pattern, handler, methods=None):
+    def __init__(self, path_pattern, handler, methods=None, singleton=False, etag=None, cache=None):
         if methods is None:
             methods = ALL_HTTP_METHODS
 
         self._path_pattern = path_pattern
+        self._parser = compile_pattern(path_pattern)
         self._handler = handler
         self._methods = [method.upper() for method in methods]
+        self._singleton = singleton
+        self.etag = etag
+        self.cache = cache
+        self._dispatch_table = self._build_dispatch_table()
+        self._async_methods = {
+            method for method, handler in self._dispatch_table.items() if inspect.iscoroutinefunction(handler)
+        }
+
+    @property
+    def path_pattern(self):
+        return self._path_pattern
 
     def match(self, request_path):
-        result = parse(self._path_pattern, request_path)
+        result = self._parser.parse(request_path)
         if result is not None:
             return True, result.named
 
         return False, None
 
-    def handle_request(self, request, response, **kwargs):
-        if inspect.isclass(self._handler):
-            handler = getattr(self._handler(), request.method.lower(), None)
-            if handler is None:
-                raise HTTPError(status=HTTPStatus.METHOD_NOT_ALLOWED)
+    def _build_dispatch_table(self):
+        """ Map each allowed HTTP method to the callable that handles it """
+        if not inspect.isclass(self._handler):
+            return {method: self._handler for method in self._methods}
+
+        instance = self._handler() if self._singleton else None
+
+        dispatch_table = {}
+        for method in ALL_HTTP_METHODS:
+            name = method.lower()
+            if not hasattr(self._handler, name):
+                continue
+
+            if instance is not None:
+                dispatch_table[method] = getattr(instance, name)
+            else:
+                dispatch_table[method] = self._make_class_invoker(name)
+
+        return dispatch_table
+
+    def _make_class_invoker(self, name):
+        handler_cls = self._handler
+
+        if inspect.iscoroutinefunction(getattr(handler_cls, name)):
+            async def invoke(request, response, **kwargs):
+                return await getattr(handler_cls(), name)(request, response, **kwargs)
         else:
-            if request.method not in self._methods:
-                raise HTTPError(status=HTTPStatus.METHOD_NOT_ALLOWED)
+            def invoke(request, response, **kwargs):
+                return getattr(handler_cls(), name)(request, response, **kwargs)
+
+        return invoke
 
-            handler = self._handler
+    def get_handler(self, method):
+        handler = self._dispatch_table.get(method)
+        if handler is None:
+            raise HTTPError(status=HTTPStatus.METHOD_NOT_ALLOWED)
+
+        return handler
+
+    def handle_request(self, request, response, **kwargs):
+        """ Run the handler on the WSGI path, where async handlers cannot be awaited """
+        handler = self.get_handler(request.method)
+        if request.method in self._async_methods:
+            raise AssertionError(
+                f"The {request.method} handler of {self._path_pattern} is async. "
+                "Async handlers are only supported under ASGI."
+            )
 
         handler(request, response, **kwargs)
@@ -0,0 +1,82 @@
+from parse import compile as compile_pattern
+
+from alcazar.utils.cache import LRUCache
+
+
+class _Node:
+    __slots__ = ("literals", "params", "route", "order")
+
+    def __init__(self):
+        self.literals = {}
+        self.params = {}
+        self.route = None
+        self.order = None
+
+
+class Router:
+    """
+    Prefix tree of routes keyed by path segments.
+
+    Static segments are literal edges and segments containing `{name:type}`
+    placeholders are typed matchers compiled once when the route is added.
+    When several routes match a path, the one added first wins.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def add(self, pattern, route):
+        node = self._root
+
+        for segment in self._split(pattern):
+            if "{" in segment:
+                if segment not in node.params:
+                    node.params[segment] = (compile_pattern(segment), _Node())
+                node = node.params[segment][1]
+            else:
+                node = node.literals.setdefault(segment.lower(), _Node())
+
+        node.route = route
+        node.order = self._count
+        self._count += 1
+
+    def find(self, path):
+        found = self._match(self._root, self._split(path), 0, {})
+        if found is None:
+            return None, {}
+
+        _, route, kwargs = found
+        return route, kwargs
+
+    def _match(self, node, segments, index, kwargs):
+        if index == len(segments):
+            if node.route is None:
+                return None
+            return node.order, node.route, kwargs
+
+        segment = segments[index]
+        best = None
+
+        child = node.literals.get(segment.lower())
+        if child is not None:
+            best = self._match(child, segments, index + 1, kwargs)
+
+        for parser, child in node.params.values():
+            result = parser.parse(segment)
+            if result is None:
+                continue
+
+            found = self._match(child, segments, index + 1, {**kwargs, **result.named})
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+
+        return best
+
+    @staticmethod
+    def _split(path):
+        return path.split("/")
+
+
+class RouteCache(LRUCache):
+    """ Bounded LRU cache of path -> (route, kwargs) resolutions """
@@ -0,0 +1,334 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import stat
+import threading
+from email.utils import formatdate
+
+from alcazar.middleware import COMPRESSIBLE_CONTENT_TYPES, parse_accept_encoding
+from alcazar.responses import status_line
+from alcazar.utils.conditional import etag_matches, not_modified_since
+from alcazar.utils.files import parse_range_header, iter_file
+
+
+MANIFEST_NAME = "staticfiles.json"
+
+IMMUTABLE_CACHE_CONTROL = "max-age=31536000, public, immutable"
+
+
+def guess_content_type(path):
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type = f"{content_type}; charset=utf-8"
+    return content_type
+
+
+def read_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def load_manifest(root):
+    return read_manifest(root).get("paths", {})
+
+
+class StaticFile:
+    """ Metadata and precomputed headers of a single static file """
+
+    __slots__ = ("path", "size", "mtime", "etag", "headers", "content", "in_memory", "gzipped")
+
+    def __init__(self, path, stat_result, cache_control, max_memory_size, content_type=None, extra_headers=()):
+        self.path = path
+        self.size = stat_result.st_size
+        self.mtime = stat_result.st_mtime
+        self.etag = f'"{int(self.mtime):x}-{self.size:x}"'
+        self.gzipped = None
+
+        self.headers = [
+            ("Content-Type", content_type or guess_content_type(path)),
+            ("ETag", self.etag),
+            ("Last-Modified", formatdate(self.mtime, usegmt=True)),
+            ("Cache-Control", cache_control),
+            ("Accept-Ranges", "bytes"),
+            *extra_headers,
+        ]
+
+        # small files are read on their first request and kept in memory from then on
+        self.content = None
+        self.in_memory = self.size <= max_memory_size
+
+    def load_content(self):
+        """ The file's bytes when it is small enough to be kept in memory, otherwise None """
+        if self.content is None and self.in_memory:
+            with open(self.path, "rb") as f:
+                self.content = f.read()
+        return self.content
+
+    def add_gzipped(self, gzipped):
+        self.gzipped = gzipped
+        if ("Vary", "Accept-Encoding") not in self.headers:
+            self.headers.append(("Vary", "Accept-Encoding"))
+
+    @property
+    def validator_headers(self):
+        """ Headers that are repeated on a 304 response """
+        return [header for header in self.headers if header[0] in ("ETag", "Last-Modified", "Cache-Control", "Vary")]
+
+    def is_stale(self, stat_result):
+        return stat_result.st_mtime != self.mtime or stat_result.st_size != self.size
+
+
+class StaticFiles:
+    """
+    WSGI app serving the files under `root` from an index built once.
+
+    Files up to `max_memory_size` bytes are kept in memory once they have
+    been requested, larger ones are handed to the server's
+    `wsgi.file_wrapper` (sendfile) or read in chunks.
+    With `autorefresh=True` (for development) nothing is indexed up front and
+    only the requested file is looked up on each request.
+
+    Files listed in the manifest written by `collect_static` are served with
+    immutable caching, and their `.gz` variants to clients that accept gzip.
+    """
+
+    def __init__(self, root, autorefresh=False, max_age=60, max_memory_size=256 * 1024):
+        self.root = os.path.abspath(root)
+        self.autorefresh = autorefresh
+        self.max_age = max_age
+        self.max_memory_size = max_memory_size
+        self.files = {}
+        self.manifest = {}
+        self._hashed_paths = set()
+        self._lock = threading.Lock()
+
+        self.load_manifest()
+        if not autorefresh:
+            self.scan()
+
+    def load_manifest(self):
+        self.manifest = load_manifest(self.root)
+        self._hashed_paths = {"/" + hashed_name for hashed_name in self.manifest.values()}
+
+    def url_for(self, name):
+        """ Path of a static file relative to the static root, using its hashed name when it has one """
+        return "/" + self.manifest.get(name.lstrip("/"), name.lstrip("/"))
+
+    def scan(self):
+        files = {}
+        for directory, _, filenames in os.walk(self.root, followlinks=True):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                url_path = "/" + os.path.relpath(path, self.root).replace(os.sep, "/")
+                files[url_path] = self._load(url_path, path, os.stat(path))
+
+        for url_path, static_file in files.items():
+            gz_file = files.get(url_path + ".gz")
+            if gz_file is not None:
+                static_file.add_gzipped(self._load_gzipped(url_path, gz_file.path, os.stat(gz_file.path)))
+
+        self.files = files
+
+    def _cache_control(self, url_path):
+        if url_path in self._hashed_paths:
+            return IMMUTABLE_CACHE_CONTROL
+        return f"max-age={self.max_age}, public"
+
+    def _load(self, url_path, path, stat_result):
+        return StaticFile(
+            path, stat_result, cache_control=self._cache_control(url_path), max_memory_size=self.max_memory_size,
+        )
+
+    def _load_gzipped(self, url_path, gz_path, stat_result):
+        return StaticFile(
+            gz_path, stat_result,
+            cache_control=self._cache_control(url_path),
+            max_memory_size=self.max_memory_size,
+            content_type=guess_content_type(url_path),
+            extra_headers=[("Content-Encoding", "gzip"), ("Vary", "Accept-Encoding")],
+        )
+
+    def _resolve(self, url_path):
+        path = os.path.normpath(os.path.join(self.root, url_path.lstrip("/")))
+        if path != self.root and path.startswith(self.root + os.sep):
+            return path
+        return None
+
+    def find_file(self, url_path):
+        if not self.autorefresh:
+            return self.files.get(url_path)
+
+        path = self._resolve(url_path)
+        if path is None:
+            return None
+
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            stat_result = None
+
+        # directories and other special files are not served
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            self.files.pop(url_path, None)
+            return None
+
+        try:
+            gz_stat_result = os.stat(path + ".gz")
+        except OSError:
+            gz_stat_result = None
+        if gz_stat_result is not None and not stat.S_ISREG(gz_stat_result.st_mode):
+            gz_stat_result = None
+
+        static_file = self.files.get(url_path)
+        if (
+            static_file is None or static_file.is_stale(stat_result)
+            or self._gzipped_is_stale(static_file.gzipped, gz_stat_result)
+        ):
+            static_file = self._load(url_path, path, stat_result)
+            if gz_stat_result is not None:
+                static_file.add_gzipped(self._load_gzipped(url_path, path + ".gz", gz_stat_result))
+            with self._lock:
+                self.files[url_path] = static_file
+
+        return static_file
+
+    @staticmethod
+    def _gzipped_is_stale(gzipped, gz_stat_result):
+        # the .gz variant appeared, disappeared or changed
+        if gzipped is None or gz_stat_result is None:
+            return (gzipped is None) != (gz_stat_result is None)
+        return gzipped.is_stale(gz_stat_result)
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        static_file = self.find_file(environ.get("PATH_INFO", ""))
+
+        if static_file is None:
+            start_response(status_line(404), [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+
+        if method not in ("GET", "HEAD"):
+            start_response(status_line(405), [("Allow", "GET, HEAD")])
+            return []
+
+        range_header = environ.get("HTTP_RANGE")
+        if static_file.gzipped is not None and range_header is None:
+            if "gzip" in parse_accept_encoding(environ.get("HTTP_ACCEPT_ENCODING")):
+                static_file = static_file.gzipped
+
+        if self._not_modified(environ, static_file):
+            start_response(status_line(304), static_file.validator_headers)
+            return []
+
+        try:
+            byte_range = parse_range_header(range_header, static_file.size)
+        except ValueError:
+            headers = static_file.headers + [("Content-Range", f"bytes */{static_file.size}")]
+            start_response(status_line(416), headers)
+            return []
+
+        if byte_range is None:
+            start, length = 0, static_file.size
+            start_response(status_line(200), static_file.headers + [("Content-Length", str(length))])
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            start_response(status_line(206), static_file.headers + [
+                ("Content-Length", str(length)),
+                ("Content-Range", f"bytes {start}-{end}/{static_file.size}"),
+            ])
+
+        if method == "HEAD":
+            return []
+
+        content = static_file.load_content()
+        if content is not None:
+            return [content[start:start + length]]
+
+        fileobj = open(static_file.path, "rb")
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if byte_range is None and file_wrapper is not None:
+            return file_wrapper(fileobj, 64 * 1024)
+        return iter_file(fileobj, start=start, length=length)
+
+    @staticmethod
+    def _not_modified(environ, static_file):
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            return etag_matches(static_file.etag, if_none_match)
+
+        if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since is not None:
+            return not_modified_since(static_file.mtime, if_modified_since)
+
+        return False
+
+
+def hashed_name(name, content):
+    digest = hashlib.blake2b(content, digest_size=6).hexdigest()
+    base, ext = os.path.splitext(name)
+    return f"{base}.{digest}{ext}"
+
+
+def collect_static(static_dir, output_dir=None, compress=True, min_compress_size=256):
+    """
+    Fingerprint every file under `static_dir` with a hash of its content.
+
+    Each file is copied to `output_dir` (by default `static_dir` itself) under
+    its hashed name, with a `.gz` variant for compressible types, and a
+    manifest mapping logical names to hashed names is written next to them.
+    Returns the manifest.
+    """
+    static_dir = os.path.abspath(static_dir)
+    output_dir = os.path.abspath(output_dir or static_dir)
+
+    # skip the files written by the previous run when collecting in place
+    skip = {MANIFEST_NAME}
+    if output_dir == static_dir:
+        previous = read_manifest(output_dir)
+        if "outputs" in previous:
+            skip.update(previous["outputs"])
+        else:
+            # manifests written before outputs were recorded
+            for name, hashed in previous.get("paths", {}).items():
+                skip.update((hashed, hashed + ".gz", name + ".gz"))
+
+    manifest = {}
+    # outputs of older runs stay generated files even when their source changed since
+    outputs = {name for name in skip - {MANIFEST_NAME} if os.path.exists(os.path.join(output_dir, *name.split("/")))}
+    for directory, _, filenames in os.walk(static_dir, followlinks=True):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            if name in skip:
+                continue
+
+            with open(path, "rb") as f:
+                content = f.read()
+
+            manifest[name] = hashed_name(name, content)
+            outputs.add(manifest[name])
+            target = os.path.join(output_dir, *manifest[name].split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if output_dir != static_dir:
+                shutil.copy2(path, os.path.join(output_dir, *name.split("/")))
+            shutil.copy2(path, target)
+
+            content_type = mimetypes.guess_type(name)[0] or ""
+            if compress and len(content) >= min_compress_size and content_type.startswith(COMPRESSIBLE_CONTENT_TYPES):
+                for gz_name in (manifest[name], name):
+                    with open(os.path.join(output_dir, *gz_name.split("/")) + ".gz", "wb") as f:
+                        f.write(gzip.compress(content, mtime=0))
+                    outputs.add(gz_name + ".gz")
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as f:
+        json.dump({"version": 1, "paths": manifest, "outputs": sorted(outputs)}, f, indent=2, sort_keys=True)
+
+    return manifest
@@ -1,5 +1,92 @@
-from jinja2 import Environment, FileSystemLoader
+import os
+import time
 
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
 
-def get_templates_env(templates_dir):
-    return Environment(loader=FileSystemLoader(templates_dir), autoescape=(["html", "xml"]))
+from alcazar.utils.cache import LRUCache
+
+
+TEMPLATE_EXTENSIONS = ("html", "htm", "xml", "txt", "jinja", "jinja2", "j2")
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds a `{% cache key, ttl %}...{% endcache %}` tag that renders its body
+    once and reuses the output until `ttl` seconds have passed. Without a
+    ttl the fragment is kept until it is evicted from the LRU.
+    """
+
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=LRUCache(1024))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_render_cached", args), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, ttl, caller):
+        cache = self.environment.fragment_cache
+
+        entry = cache.get(key)
+        if entry is not None:
+            expires_at, fragment = entry
+            if expires_at is None or expires_at > time.monotonic():
+                return fragment
+
+        fragment = caller()
+        cache.set(key, (None if ttl is None else time.monotonic() + ttl, fragment))
+        return fragment
+
+
+def get_templates_env(templates_dir, bytecode_cache_dir=None):
+    bytecode_cache = None
+    if bytecode_cache_dir is not None:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+    return Environment(
+        loader=FileSystemLoader(templates_dir),
+        autoescape=(["html", "xml"]),
+        bytecode_cache=bytecode_cache,
+        extensions=[FragmentCacheExtension],
+    )
+
+
+def compile_templates(env, extensions=TEMPLATE_EXTENSIONS):
+    """
+    Compile every template with one of `extensions` up front instead of on
+    first use, skipping other files such as images or editor swap files.
+    """
+    names = env.list_templates(extensions=extensions)
+    for name in names:
+        env.get_template(name)
+
+    return names
+
+
+def generate_buffered(template, context, buffer_size=8192):
+    """ Render a template incrementally, yielding chunks of at least `buffer_size` characters """
+    buffer = []
+    buffered = 0
+
+    for part in template.generate(**context):
+        buffer.append(part)
+        buffered += len(part)
+        if buffered >= buffer_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield "".join(buffer)
@@ -0,0 +1,239 @@
+import collections
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+_current_span = contextvars.ContextVar("alcazar_current_span", default=None)
+
+
+def current_span():
+    """ The innermost open span of the current request, or None when it is not traced """
+    return _current_span.get()
+
+
+class Span:
+    """ A timed, named operation. Spans opened while another one is open become its children """
+
+    __slots__ = ("name", "attributes", "parent", "children", "timestamp", "start", "end", "_token", "_on_end")
+
+    def __init__(self, name, attributes=None, parent=None, on_end=None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.parent = parent
+        self.children = []
+        self.timestamp = None
+        self.start = None
+        self.end = None
+        self._token = None
+        self._on_end = on_end
+
+    def begin(self):
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        if self.parent is not None:
+            self.parent.children.append(self)
+
+    def finish(self, exc_type=None):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        if self._on_end is not None:
+            self._on_end(self)
+
+    def __enter__(self):
+        self.begin()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        self.finish(exc_type)
+        return False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        """ Seconds the span took, or has taken so far while it is open """
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def walk(self):
+        """ This span and all its descendants, depth first """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self, root_start=None):
+        if root_start is None:
+            root_start = self.start
+
+        data = {
+            "name": self.name,
+            "offset": self.start - root_start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "children": [child.to_dict(root_start) for child in self.children],
+        }
+        if self.parent is None:
+            data["timestamp"] = self.timestamp
+        return data
+
+
+class _NoopSpan:
+    """ Returned by `span` outside of a traced request, so instrumentation costs next to nothing """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attributes):
+    """ Open a child span of the current span. Does nothing when the request is not traced """
+    parent = _current_span.get()
+    if parent is None:
+        return _NOOP_SPAN
+    return Span(name, attributes, parent=parent)
+
+
+def server_timing(root):
+    """ `Server-Timing` header value summing the durations of the spans under `root` by name """
+    totals = {}
+    for child in root.walk():
+        if child is not root:
+            totals[child.name] = totals.get(child.name, 0.0) + child.duration
+
+    metrics = [f"{name};dur={duration * 1000:.3f}" for name, duration in totals.items()]
+    metrics.append(f"total;dur={root.duration * 1000:.3f}")
+    return ", ".join(metrics)
+
+
+def traced_start_response(start_response, root, add_server_timing=False):
+    """ Wrap a WSGI `start_response` to record the status on `root` and optionally add `Server-Timing` """
+    def wrapper(status, headers, exc_info=None):
+        root.set("status", int(status.split(" ", 1)[0]))
+        if add_server_timing:
+            headers = list(headers) + [("Server-Timing", server_timing(root))]
+        return start_response(status, headers, exc_info)
+
+    return wrapper
+
+
+def traced_send(send, root, add_server_timing=False):
+    """ ASGI counterpart of `traced_start_response` """
+    async def wrapper(message):
+        if message["type"] == "http.response.start":
+            root.set("status", message["status"])
+            if add_server_timing:
+                header = (b"server-timing", server_timing(root).encode("latin-1"))
+                message = dict(message, headers=list(message.get("headers", [])) + [header])
+        await send(message)
+
+    return wrapper
+
+
+@contextmanager
+def use_span(span):
+    """ Make `span` the current span inside the block, without starting or finishing it """
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+class TracedBody:
+    """
+    WSGI body iterable that keeps `root` current while the body is produced
+    and finishes it when the server closes the body, so spans opened by
+    streamed bodies still belong to the request.
+    """
+
+    def __init__(self, app_iter, root):
+        self.app_iter = app_iter
+        self.root = root
+
+    def __iter__(self):
+        chunks = iter(self.app_iter)
+        while True:
+            with use_span(self.root):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                with use_span(self.root):
+                    self.app_iter.close()
+        finally:
+            self.root.finish()
+
+
+class RingBufferExporter:
+    """ Keeps the last `maxlen` traces in memory """
+
+    def __init__(self, maxlen=1000):
+        self.traces = collections.deque(maxlen=maxlen)
+
+    def export(self, root):
+        self.traces.append(root)
+
+
+class JSONLinesExporter:
+    """ Appends each trace to `path` as one line of JSON """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, root):
+        line = json.dumps(root.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class CallbackExporter:
+    """ Calls `callback(root_span)` with each finished trace """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, root):
+        self.callback(root)
+
+
+class Tracer:
+    """
+    Creates a root span per request and hands finished traces to `exporters`.
+
+    With `server_timing=True` a `Server-Timing` header breaking the request
+    down by span name is added to every traced response.
+    """
+
+    def __init__(self, exporters=(), server_timing=False):
+        self.exporters = list(exporters)
+        self.server_timing = server_timing
+
+    def trace(self, name, **attributes):
+        return Span(name, attributes, on_end=self._export)
+
+    def _export(self, root):
+        for exporter in self.exporters:
+            exporter.export(root)
@@ -1,3 +1,6 @@
+from .asgi import *
+from .cache import *
+from .conditional import *
+from .files import *
 from .static import *
 from .tests import *
-from .wsgi import *
@@ -0,0 +1,172 @@
+import asyncio
+import contextvars
+import io
+import sys
+
+
+async def read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+
+    return b"".join(chunks)
+
+
+def build_environ(scope, body):
+    """ Translate an ASGI HTTP scope into a WSGI environ """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = f"HTTP_{name}"
+
+        if key in environ:
+            value = f"{environ[key]},{value}"
+        environ[key] = value
+
+    if body and "CONTENT_LENGTH" not in environ:
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+    return environ
+
+
+def encode_headers(headerlist):
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headerlist]
+
+
+def start_wsgi(app, environ):
+    """ Call a WSGI app that starts its response right away and return its status code, headers and body iterable """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = status
+        started["headers"] = headers
+
+    result = app(environ, start_response)
+    return int(started["status"].split(" ", 1)[0]), started["headers"], result
+
+
+def call_wsgi(app, environ):
+    """ Run a WSGI app to completion and return its status code, headers and body """
+    status, headers, result = start_wsgi(app, environ)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+    return status, headers, body
+
+
+_HOP_END = object()
+
+
+async def send_body(send, app_iter, run_sync, chunks_per_hop=64):
+    """
+    Send a WSGI style body iterable as ASGI body messages.
+
+    Sync iterables may block (file reads, template rendering, database
+    cursors), so they are pulled with `run_sync`, up to `chunks_per_hop`
+    chunks per thread hop. Every chunk is handed to the event loop as soon
+    as it is produced, and chunks that are ready together go out as one
+    message, so a slow generator is never held back to fill a batch.
+    """
+    context = contextvars.copy_context()
+    try:
+        if isinstance(app_iter, list):
+            await send({"type": "http.response.body", "body": b"".join(app_iter)})
+            return
+
+        if hasattr(app_iter, "__aiter__"):
+            async for chunk in app_iter:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            await _send_sync_chunks(send, iter(app_iter), run_sync, context, chunks_per_hop)
+
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(app_iter, "aclose"):
+            await app_iter.aclose()
+        elif hasattr(app_iter, "close"):
+            await run_sync(context.run, app_iter.close)
+
+
+async def _send_sync_chunks(send, chunks, run_sync, context, chunks_per_hop):
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Queue()
+
+    def pull():
+        """ Runs in the thread pool. Returns whether the iterator is exhausted """
+        try:
+            for _ in range(chunks_per_hop):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return True
+                loop.call_soon_threadsafe(ready.put_nowait, chunk)
+            return False
+        finally:
+            loop.call_soon_threadsafe(ready.put_nowait, _HOP_END)
+
+    exhausted = False
+    while not exhausted:
+        # one context for the whole body, so spans opened by a generator close in the context they began in
+        hop = asyncio.ensure_future(run_sync(context.run, pull))
+        try:
+            hop_ended = False
+            while not hop_ended:
+                batch = [await ready.get()]
+                while not ready.empty():
+                    batch.append(ready.get_nowait())
+                hop_ended = batch[-1] is _HOP_END
+                if hop_ended:
+                    batch.pop()
+                if batch:
+                    await send({"type": "http.response.body", "body": b"".join(batch), "more_body": True})
+        except BaseException:
+            # let the pull finish before the body is closed from another thread
+            await asyncio.wait([hop])
+            raise
+
+        exhausted = await hop
+
+
+async def handle_lifespan(receive, send, on_shutdown=None):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if on_shutdown is not None:
+                on_shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,52 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+
+def generate_etag(body):
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def quote_etag(etag):
+    if etag.startswith(('"', 'W/"')):
+        return etag
+    return f'"{etag}"'
+
+
+def etag_matches(etag, if_none_match):
+    """ Weak comparison of an entity tag against an If-None-Match header """
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    etag = opaque(quote_etag(etag))
+    return any(opaque(candidate) == etag for candidate in if_none_match.split(","))
+
+
+def to_utc_datetime(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def format_http_date(value):
+    return format_datetime(to_utc_datetime(value), usegmt=True)
+
+
+def not_modified_since(last_modified, if_modified_since):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+    if since is None:
+        return False
+
+    # HTTP dates have a resolution of one second
+    last_modified = to_utc_datetime(last_modified).replace(microsecond=0)
+    return last_modified <= to_utc_datetime(since)
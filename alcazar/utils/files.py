@@ -0,0 +1,55 @@
+import os
+
+
+def get_file_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError):
+        position = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+        return size
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single `bytes=start-end` range into an inclusive (start, end) pair.
+
+    Returns None when the header should be ignored and raises ValueError
+    when the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+
+    start, sep, end = header[len("bytes="):].strip().partition("-")
+    if not sep or not start + end or not all(x.isdigit() or x == "" for x in (start, end)):
+        return None
+
+    if start == "":
+        # suffix range: the last N bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError("Range not satisfiable.")
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable.")
+
+    return start, min(end, size - 1)
+
+
+def iter_file(fileobj, start=0, length=None, chunk_size=64 * 1024):
+    try:
+        fileobj.seek(start)
+        while length is None or length > 0:
+            to_read = chunk_size if length is None else min(chunk_size, length)
+            chunk = fileobj.read(to_read)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
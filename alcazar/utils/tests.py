@@ -1,2 +1,38 @@
+import asyncio
+from urllib.parse import urlsplit
+
+
 def url(s):
     return f"http://testserver{s}"
+
+
+def asgi_request(app, method, path, headers=None, body=b""):
+    """ Send a single request through `app.asgi` and return (status, headers, body) """
+    parts = urlsplit(path)
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method.upper(),
+        "scheme": "http",
+        "path": parts.path,
+        "root_path": "",
+        "query_string": parts.query.encode("latin-1"),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 50000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.asgi(scope, receive, send))
+
+    start = sent[0]
+    response_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in start["headers"]}
+    response_body = b"".join(message.get("body", b"") for message in sent[1:])
+    return start["status"], response_headers, response_body
@@ -17,7 +17,7 @@ DESCRIPTION = "Python Web Framework built for learning purposes."
 URL = "https://github.com/rahmonov/alcazar"
 EMAIL = "jrahmonov2@gmail.com   "
 AUTHOR = "Jahongir Rahmonov"
-REQUIRES_PYTHON = ">=3.6.0"
+REQUIRES_PYTHON = ">=3.8.0"
 VERSION = "0.0.2"
 
 # What packages are required for this module to be executed?
@@ -27,12 +27,11 @@ REQUIRED = [
     "parse==1.11.1",
     "requests==2.21.0",
     "WebOb==1.8.5",
-    "whitenoise==4.1.2",
 ]
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    "orjson": ["orjson"],
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -111,9 +110,9 @@ setup(
     packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['mypackage'],
-    # entry_points={
-    #     'console_scripts': ['mycli=mymodule:cli'],
-    # },
+    entry_points={
+        'console_scripts': ['alcazar=alcazar.__main__:main'],
+    },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
     include_package_data=True,
@@ -124,7 +123,7 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
     ],
@@ -0,0 +1,246 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from alcazar.middleware import Middleware
+from alcazar.utils.asgi import send_body
+from alcazar.utils.tests import asgi_request, url
+
+
+def test_async_handler(app):
+    @app.route("/hello/{name}")
+    async def hello(req, resp, name):
+        await asyncio.sleep(0)
+        resp.text = f"hey {name}"
+
+    status, headers, body = asgi_request(app, "get", "/hello/matthew")
+
+    assert status == 200
+    assert "text/plain" in headers["content-type"]
+    assert body == b"hey matthew"
+
+
+def test_sync_handler_runs_in_thread_pool(app):
+    threads = []
+
+    @app.route("/")
+    def home(req, resp):
+        threads.append(threading.current_thread())
+        resp.json = {"name": "alcazar"}
+
+    status, headers, body = asgi_request(app, "get", "/")
+
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert body == b'{"name":"alcazar"}'
+    assert threads[0] is not threading.main_thread()
+
+
+def test_async_class_based_handler(app):
+    @app.route("/book")
+    class BookResource:
+        async def post(self, req, resp):
+            resp.text = req.body.decode()
+
+    status, _, body = asgi_request(app, "post", "/book", body=b"a book")
+
+    assert status == 200
+    assert body == b"a book"
+
+
+def test_async_handlers_are_refused_under_wsgi(app, client):
+    @app.route("/hello")
+    async def hello(req, resp):
+        resp.text = "hey"
+
+    @app.route("/book")
+    class BookResource:
+        async def get(self, req, resp):
+            resp.text = "a book"
+
+    with pytest.raises(AssertionError, match="GET handler of /hello is async"):
+        client.get(url("/hello"))
+    with pytest.raises(AssertionError, match="only supported under ASGI"):
+        client.get(url("/book"))
+
+
+def test_request_is_built_from_scope(app):
+    @app.route("/echo")
+    async def echo(req, resp):
+        resp.json = {"q": req.GET["q"], "agent": req.headers["User-Agent"], "method": req.method}
+
+    _, _, body = asgi_request(app, "put", "/echo?q=orm", headers={"User-Agent": "pytest"})
+
+    assert body == b'{"q":"orm","agent":"pytest","method":"PUT"}'
+
+
+def test_not_allowed_method_is_handled_by_exception_handler(app):
+    app.add_exception_handler(lambda req, resp, exc: setattr(resp, "text", str(exc)))
+
+    @app.route("/", methods=["get"])
+    async def home(req, resp):
+        resp.text = "home"
+
+    _, _, body = asgi_request(app, "post", "/")
+
+    assert body == b"405 Method Not Allowed"
+
+
+def test_async_middleware_hooks_are_awaited(app):
+    calls = []
+
+    class AsyncMiddleware(Middleware):
+        async def process_request(self, req):
+            calls.append("request")
+
+        async def process_response(self, req, resp):
+            calls.append("response")
+
+    app.add_middleware(AsyncMiddleware)
+
+    @app.route("/")
+    async def home(req, resp):
+        resp.text = "home"
+
+    asgi_request(app, "get", "/")
+
+    assert calls == ["request", "response"]
+
+
+def test_lifespan_events_are_acknowledged(app):
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(app.asgi({"type": "lifespan"}, receive, send))
+
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+def test_streaming_response_with_sync_iterator(app):
+    @app.route("/export")
+    async def export(req, resp):
+        resp.stream = (f"row {i}\n" for i in range(3))
+
+    status, headers, body = asgi_request(app, "get", "/export")
+
+    assert status == 200
+    assert "content-length" not in headers
+    assert body == b"row 0\nrow 1\nrow 2\n"
+
+
+def test_sync_stream_is_pulled_in_app_thread_pool(app):
+    pulled_in = []
+
+    def chunks():
+        for i in range(3):
+            pulled_in.append(threading.current_thread())
+            yield str(i)
+
+    @app.route("/stream")
+    async def stream(req, resp):
+        resp.stream = chunks()
+
+    status, headers, body = asgi_request(app, "get", "/stream")
+
+    assert body == b"012"
+    assert set(pulled_in) <= set(app._executor._threads)
+
+
+def test_streaming_response_with_async_iterator(app):
+    async def rows():
+        for i in range(3):
+            await asyncio.sleep(0)
+            yield f"row {i}\n"
+
+    @app.route("/export")
+    async def export(req, resp):
+        resp.stream = rows()
+        resp.content_type = "text/csv"
+
+    status, headers, body = asgi_request(app, "get", "/export")
+
+    assert "text/csv" in headers["content-type"]
+    assert body == b"row 0\nrow 1\nrow 2\n"
+
+
+def test_file_response_with_range(app, tmp_path):
+    path = tmp_path / "report.txt"
+    path.write_bytes(b"0123456789")
+
+    @app.route("/report")
+    async def report(req, resp):
+        resp.file(str(path))
+
+    status, headers, body = asgi_request(app, "get", "/report", headers={"Range": "bytes=2-4"})
+
+    assert status == 206
+    assert headers["content-range"] == "bytes 2-4/10"
+    assert body == b"234"
+
+
+def test_send_body_pulls_sync_iterators_in_the_thread_pool():
+    pulled_in = set()
+    closed = []
+
+    class Body:
+        def __iter__(self):
+            for i in range(10):
+                pulled_in.add(threading.get_ident())
+                yield b"x" * 10
+
+        def close(self):
+            closed.append(True)
+
+    async def run_sync(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def main():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await send_body(send, Body(), run_sync, chunks_per_hop=3)
+        return sent, threading.get_ident()
+
+    sent, loop_thread = asyncio.run(main())
+
+    assert b"".join(message["body"] for message in sent) == b"x" * 100
+    assert all(len(message["body"]) <= 30 for message in sent)
+    assert "more_body" not in sent[-1]
+    assert loop_thread not in pulled_in
+    assert closed == [True]
+
+
+def test_send_body_sends_each_chunk_as_soon_as_it_is_produced():
+    def slow_rows():
+        for i in range(3):
+            time.sleep(0.1)
+            yield f"{i}\n".encode()
+
+    async def run_sync(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def main():
+        started = time.perf_counter()
+        arrivals = []
+
+        async def send(message):
+            if message["body"]:
+                arrivals.append((message["body"], time.perf_counter() - started))
+
+        await send_body(send, slow_rows(), run_sync)
+        return arrivals
+
+    arrivals = asyncio.run(main())
+
+    assert [body for body, _ in arrivals] == [b"0\n", b"1\n", b"2\n"]
+    assert arrivals[0][1] < 0.2
@@ -45,3 +45,46 @@ def test_cb_handlers_ignore_route_methods(app, client):
             resp.text = response_text
 
     assert client.get(url("/book")).text == response_text
+
+
+def test_class_based_handler_is_instantiated_per_request_by_default(app, client):
+    instances = []
+
+    @app.route("/book")
+    class BookResource:
+        def __init__(self):
+            instances.append(self)
+
+        def get(self, req, resp):
+            resp.text = "book"
+
+    client.get(url("/book"))
+    client.get(url("/book"))
+
+    assert len(instances) == 2
+
+
+def test_singleton_class_based_handler_is_instantiated_once(app, client):
+    instances = []
+
+    @app.route("/book", singleton=True)
+    class BookResource:
+        def __init__(self):
+            instances.append(self)
+
+        def get(self, req, resp):
+            resp.text = "book"
+
+    assert client.get(url("/book")).text == "book"
+    assert client.get(url("/book")).text == "book"
+    assert len(instances) == 1
+
+
+def test_singleton_class_based_handler_not_allowed_method(app, client):
+    @app.route("/book", singleton=True)
+    class BookResource:
+        def post(self, req, resp):
+            resp.text = "yolo"
+
+    with pytest.raises(HTTPError):
+        client.get(url("/book"))
@@ -0,0 +1,155 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import alcazar
+from alcazar.middleware import Middleware
+from alcazar.utils.conditional import etag_matches, generate_etag, not_modified_since
+from alcazar.utils.tests import url
+
+
+@pytest.fixture
+def etag_app():
+    return alcazar.Alcazar(templates_dir="tests/templates", debug=False, etags=True)
+
+
+@pytest.mark.parametrize(
+    "etag, if_none_match, matches",
+    [
+        ('"abc"', '"abc"', True),
+        ('W/"abc"', '"abc"', True),
+        ("abc", 'W/"abc"', True),
+        ('"abc"', '"xyz", "abc"', True),
+        ('"abc"', "*", True),
+        ('"abc"', '"xyz"', False),
+    ]
+)
+def test_etag_matches(etag, if_none_match, matches):
+    assert etag_matches(etag, if_none_match) is matches
+
+
+def test_not_modified_since():
+    last_modified = datetime(2019, 2, 1, 12, 0, 0, 500, tzinfo=timezone.utc)
+
+    assert not_modified_since(last_modified, "Fri, 01 Feb 2019 12:00:00 GMT") is True
+    assert not_modified_since(last_modified, "Fri, 01 Feb 2019 11:59:59 GMT") is False
+    assert not_modified_since(last_modified, "not a date") is False
+
+
+def test_etags_are_off_by_default(app, client):
+    @app.route("/")
+    def home(req, resp):
+        resp.text = "home"
+
+    assert "ETag" not in client.get(url("/")).headers
+
+
+def test_app_wide_etags(etag_app):
+    client = etag_app.session()
+
+    @etag_app.route("/")
+    def home(req, resp):
+        resp.text = "home"
+
+    response = client.get(url("/"))
+    etag = response.headers["ETag"]
+
+    assert etag == generate_etag(b"home")
+
+    not_modified = client.get(url("/"), headers={"If-None-Match": etag})
+
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["ETag"] == etag
+    assert "Content-Type" not in not_modified.headers
+
+    assert client.get(url("/"), headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_etag_is_computed_from_the_body_after_middleware(etag_app):
+    client = etag_app.session()
+    version = ["v1"]
+
+    class Footer(Middleware):
+        def process_response(self, req, resp):
+            resp.body = resp.finalize() + f" {version[0]}".encode()
+
+    etag_app.add_middleware(Footer)
+
+    @etag_app.route("/")
+    def home(req, resp):
+        resp.text = "home"
+
+    etag = client.get(url("/")).headers["ETag"]
+    assert etag == generate_etag(b"home v1")
+
+    version[0] = "v2"
+    response = client.get(url("/"), headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == generate_etag(b"home v2")
+
+
+def test_route_can_opt_out_of_app_wide_etags(etag_app):
+    client = etag_app.session()
+
+    @etag_app.route("/", etag=False)
+    def home(req, resp):
+        resp.text = "home"
+
+    assert "ETag" not in client.get(url("/")).headers
+
+
+def test_route_can_opt_into_etags(app, client):
+    @app.route("/", etag=True)
+    def home(req, resp):
+        resp.json = {"name": "alcazar"}
+
+    etag = client.get(url("/")).headers["ETag"]
+
+    assert client.get(url("/"), headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_handler_supplied_etag(app, client):
+    @app.route("/book")
+    def book(req, resp):
+        resp.etag = "v42"
+        resp.text = "book"
+
+    response = client.get(url("/book"))
+
+    assert response.headers["ETag"] == '"v42"'
+    assert client.get(url("/book"), headers={"If-None-Match": '"v42"'}).status_code == 304
+    assert client.post(url("/book"), headers={"If-None-Match": '"v42"'}).status_code == 200
+
+
+def test_handler_can_skip_rendering(app, client):
+    rendered = []
+
+    @app.route("/book")
+    def book(req, resp):
+        resp.etag = "v42"
+        if resp.not_modified(req):
+            return
+
+        rendered.append(True)
+        resp.text = "book"
+
+    client.get(url("/book"))
+    response = client.get(url("/book"), headers={"If-None-Match": '"v42"'})
+
+    assert response.status_code == 304
+    assert rendered == [True]
+
+
+def test_last_modified(app, client):
+    @app.route("/book")
+    def book(req, resp):
+        resp.last_modified = datetime(2019, 2, 1, 12, 0, 0, tzinfo=timezone.utc)
+        resp.text = "book"
+
+    response = client.get(url("/book"))
+
+    assert response.headers["Last-Modified"] == "Fri, 01 Feb 2019 12:00:00 GMT"
+    assert client.get(url("/book"), headers={"If-Modified-Since": "Fri, 01 Feb 2019 12:00:00 GMT"}).status_code == 304
+    assert client.get(url("/book"), headers={"If-Modified-Since": "Thu, 31 Jan 2019 12:00:00 GMT"}).status_code == 200
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import alcazar
+from alcazar.encoders import JSONEncoder, StdlibJSONEncoder, OrjsonEncoder, get_json_encoder, orjson
+from alcazar.utils.tests import url
+
+
+def test_stdlib_encoder_dumps_to_compact_bytes():
+    assert StdlibJSONEncoder().dumps({"name": "alcazar", "tags": [1, 2]}) == b'{"name":"alcazar","tags":[1,2]}'
+
+
+@pytest.mark.parametrize("items", [[], [1], [{"id": 1}, {"id": 2}, {"id": 3}]])
+def test_iter_list_encodes_a_json_array(items):
+    assert json.loads(b"".join(StdlibJSONEncoder().iter_list(items))) == items
+
+
+def test_iter_list_yields_buffered_chunks():
+    chunks = list(StdlibJSONEncoder().iter_list(range(1000), buffer_size=100))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) < 200 for chunk in chunks)
+    assert json.loads(b"".join(chunks)) == list(range(1000))
+
+
+def test_iter_list_consumes_items_lazily():
+    consumed = []
+
+    def items():
+        for i in range(3):
+            consumed.append(i)
+            yield i
+
+    chunks = StdlibJSONEncoder().iter_list(items(), buffer_size=1)
+    next(chunks)
+
+    assert consumed == [0]
+
+
+def test_get_json_encoder():
+    assert isinstance(get_json_encoder(), StdlibJSONEncoder)
+    assert isinstance(get_json_encoder("auto"), OrjsonEncoder if orjson is not None else StdlibJSONEncoder)
+
+    encoder = StdlibJSONEncoder()
+    assert get_json_encoder(encoder) is encoder
+
+    with pytest.raises(AssertionError):
+        get_json_encoder("unknown")
+
+
+def test_json_encoders_must_implement_dumps():
+    class Incomplete(JSONEncoder):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_orjson_encoder():
+    pytest.importorskip("orjson")
+
+    assert OrjsonEncoder().dumps({"name": "alcazar"}) == b'{"name":"alcazar"}'
+
+
+def test_app_uses_configured_json_encoder():
+    class UpperEncoder(JSONEncoder):
+        name = "upper"
+
+        def dumps(self, obj):
+            return json.dumps(obj).upper().encode()
+
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, json_encoder=UpperEncoder())
+    client = app.session()
+
+    @app.route("/json")
+    def json_handler(req, resp):
+        resp.json = {"name": "alcazar"}
+
+    assert client.get(url("/json")).json() == {"NAME": "ALCAZAR"}
+
+
+def test_streaming_json_response(app, client):
+    @app.route("/books")
+    def books(req, resp):
+        resp.stream_json({"id": i} for i in range(500))
+
+    response = client.get(url("/books"))
+
+    assert response.headers["Content-Type"] == "application/json"
+    assert "Content-Length" not in response.headers
+    assert response.json() == [{"id": i} for i in range(500)]
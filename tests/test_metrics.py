@@ -0,0 +1,163 @@
+import os
+import time
+
+import pytest
+
+import alcazar
+from alcazar.metrics import Metrics
+from alcazar.utils import url
+
+
+@pytest.fixture
+def metrics_app():
+    return alcazar.Alcazar(templates_dir="tests/templates", debug=False, metrics=True)
+
+
+def test_metrics_are_labelled_by_route_pattern(metrics_app):
+    client = metrics_app.session()
+
+    @metrics_app.route("/users/{id}")
+    def user(req, resp, id):
+        resp.text = id
+
+    client.get(url("/users/1"))
+    client.get(url("/users/2"))
+    with pytest.raises(alcazar.exceptions.HTTPError):
+        client.get(url("/nowhere"))
+
+    snapshot = metrics_app.metrics.snapshot()
+
+    assert snapshot["/users/{id}"]["statuses"] == {"2xx": 2}
+    assert snapshot["/users/{id}"]["count"] == 2
+    assert snapshot["/users/{id}"]["in_flight"] == 0
+    assert sum(snapshot["/users/{id}"]["buckets"]) == 2
+    assert snapshot["<unmatched>"]["statuses"] == {"4xx": 1}
+
+
+def test_metrics_count_unhandled_exceptions_as_server_errors(metrics_app):
+    client = metrics_app.session()
+
+    @metrics_app.route("/")
+    def index(req, resp):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        client.get(url("/"))
+
+    assert metrics_app.metrics.snapshot()["/"]["statuses"] == {"5xx": 1}
+
+
+def test_metrics_endpoint_renders_prometheus_format(metrics_app):
+    client = metrics_app.session()
+
+    @metrics_app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    client.get(url("/"))
+    response = client.get(url("/metrics"))
+
+    assert response.headers["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+    assert '# TYPE alcazar_request_duration_seconds histogram' in response.text
+    assert 'alcazar_requests_total{route="/",status="2xx"} 1' in response.text
+    assert 'alcazar_request_duration_seconds_bucket{route="/",le="+Inf"} 1' in response.text
+    assert 'alcazar_request_duration_seconds_count{route="/"} 1' in response.text
+    # the scrape itself is still in flight while rendering
+    assert 'alcazar_requests_in_flight{route="/metrics"} 1' in response.text
+
+
+def test_metrics_are_disabled_by_default(app):
+    assert app.metrics is None
+    assert app.find_route("/metrics")[0] is None
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics(buckets=(0.1, 1.0))
+
+    for duration in (0.05, 0.1, 0.5, 5.0):
+        metrics.request_started("/")
+        metrics.request_finished("/", 200, duration)
+
+    text = metrics.render()
+
+    assert 'alcazar_request_duration_seconds_bucket{route="/",le="0.1"} 2' in text
+    assert 'alcazar_request_duration_seconds_bucket{route="/",le="1"} 3' in text
+    assert 'alcazar_request_duration_seconds_bucket{route="/",le="+Inf"} 4' in text
+    assert 'alcazar_request_duration_seconds_sum{route="/"} 5.65' in text
+
+
+def worker_file(tmp_path):
+    path, = tmp_path.glob(f"metrics-{os.getpid()}-*.json")
+    return path
+
+
+def test_multiprocess_metrics_are_aggregated(tmp_path):
+    # counters written by another worker that has exited
+    other = Metrics(multiprocess_dir=str(tmp_path))
+    other.request_started("/")
+    other.request_started("/")
+    other.request_finished("/", 500, 0.02)
+    other.flush()
+    worker_file(tmp_path).rename(tmp_path / "metrics-999999999-1.json")
+
+    worker = Metrics(multiprocess_dir=str(tmp_path))
+    worker.request_started("/")
+    worker.request_finished("/", 200, 0.01)
+
+    collected = worker.collect()
+
+    assert collected["/"]["statuses"] == {"2xx": 1, "5xx": 1}
+    assert collected["/"]["count"] == 2
+    assert collected["/"]["in_flight"] == 0
+    # the exited worker's file is folded into the archive, without counting it twice
+    assert not (tmp_path / "metrics-999999999-1.json").exists()
+    assert (tmp_path / "archive.json").exists()
+    assert worker.collect()["/"]["count"] == 2
+
+
+def test_idle_workers_are_reported(tmp_path):
+    idle = Metrics(multiprocess_dir=str(tmp_path), flush_interval=0.01)
+    idle.request_started("/")
+    idle.request_finished("/", 200, 0.01)
+    # written by the worker's background thread, without another request or scrape
+    for _ in range(100):
+        if list(tmp_path.glob("metrics-*.json")):
+            break
+        time.sleep(0.01)
+    # another process that is still running and has not served a request since
+    worker_file(tmp_path).rename(tmp_path / f"metrics-{os.getppid()}-1.json")
+
+    assert Metrics(multiprocess_dir=str(tmp_path)).collect()["/"]["count"] == 1
+
+
+def test_recycled_pids_do_not_overwrite_exited_workers(tmp_path):
+    for started in (1, 2):
+        worker = Metrics(multiprocess_dir=str(tmp_path))
+        worker.request_started("/")
+        worker.request_started("/")
+        worker.request_finished("/", 200, 0.01)
+        worker.flush()
+        worker_file(tmp_path).rename(tmp_path / f"metrics-{os.getppid()}-{started}.json")
+
+    collected = Metrics(multiprocess_dir=str(tmp_path)).collect()
+
+    assert collected["/"]["count"] == 2
+    # only the newest worker with that pid is still running
+    assert collected["/"]["in_flight"] == 1
+    assert not (tmp_path / f"metrics-{os.getppid()}-1.json").exists()
+
+
+def test_workers_only_rewrite_changed_counters(tmp_path):
+    worker = Metrics(multiprocess_dir=str(tmp_path))
+    worker.request_started("/")
+    worker.request_finished("/", 200, 0.01)
+    worker.flush()
+    path = worker_file(tmp_path)
+    path.write_text(path.read_text().replace('"count": 1', '"count": 7'))
+
+    worker.flush()
+    assert '"count": 7' in path.read_text()
+
+    worker.request_started("/")
+    worker.flush()
+    assert '"count": 1' in path.read_text()
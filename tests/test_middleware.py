@@ -1,5 +1,15 @@
-from alcazar.middleware import Middleware
-from alcazar.utils import url
+import asyncio
+import gzip
+import json
+import threading
+import time
+import zlib
+
+import pytest
+
+from alcazar.middleware import Middleware, CompressionMiddleware, CacheMiddleware, ProfilingMiddleware
+from alcazar.profiling import profile_token
+from alcazar.utils import url, asgi_request
 
 
 def test_middleware_methods_are_called(app, client):
@@ -29,3 +39,504 @@ def test_middleware_methods_are_called(app, client):
 
     assert process_request_called is True
     assert process_response_called is True
+
+
+def test_middleware_hooks_run_in_order(app, client):
+    calls = []
+
+    def make_middleware(name):
+        class RecordingMiddleware(Middleware):
+            def process_request(self, req):
+                calls.append(f"{name}.request")
+
+            def process_response(self, req, resp):
+                calls.append(f"{name}.response")
+
+        return RecordingMiddleware
+
+    app.add_middleware(make_middleware("inner"))
+    app.add_middleware(make_middleware("outer"))
+
+    @app.route("/")
+    def index(req, resp):
+        calls.append("handler")
+        resp.text = "YOLO"
+
+    client.get(url("/"))
+
+    assert calls == ["outer.request", "inner.request", "handler", "inner.response", "outer.response"]
+
+
+def test_process_request_can_short_circuit(app, client):
+    calls = []
+
+    class Inner(Middleware):
+        def process_request(self, req):
+            calls.append("inner.request")
+
+        def process_response(self, req, resp):
+            calls.append("inner.response")
+
+    class Deny(Middleware):
+        def process_request(self, req):
+            resp = app.make_response()
+            resp.status_code = 403
+            resp.text = "Forbidden"
+            return resp
+
+    class Outer(Middleware):
+        def process_response(self, req, resp):
+            calls.append("outer.response")
+
+    app.add_middleware(Inner)
+    app.add_middleware(Deny)
+    app.add_middleware(Outer)
+
+    @app.route("/")
+    def index(req, resp):
+        calls.append("handler")
+        resp.text = "YOLO"
+
+    response = client.get(url("/"))
+
+    assert response.status_code == 403
+    assert response.text == "Forbidden"
+    assert calls == ["outer.response"]
+
+
+def test_pipeline_skips_hooks_that_are_not_overridden(app):
+    class RequestOnly(Middleware):
+        def process_request(self, req):
+            pass
+
+    class ResponseOnly(Middleware):
+        def process_response(self, req, resp):
+            pass
+
+    app.add_middleware(RequestOnly)
+    app.add_middleware(ResponseOnly)
+
+    pipeline = app._middleware.pipeline
+
+    assert len(pipeline.middlewares) == 2
+    assert [hook.__self__.__class__ for _, hook in pipeline.request_hooks] == [RequestOnly]
+    assert [hook.__self__.__class__ for _, hook in pipeline.response_hooks] == [ResponseOnly]
+    assert pipeline.exception_hooks == []
+    assert pipeline.app is app
+
+
+def test_middleware_overriding_dispatch_keeps_layers_below_flat(app, client):
+    calls = []
+
+    class Inner(Middleware):
+        def process_request(self, req):
+            calls.append("inner")
+
+    class Outer(Middleware):
+        def dispatch_request(self, request):
+            calls.append("outer")
+            return super().dispatch_request(request)
+
+    app.add_middleware(Inner)
+    app.add_middleware(Outer)
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    outer = app._middleware.app
+    inner = outer.app
+    # layers below are run by the compiled pipeline, not dispatched one by one
+    inner.dispatch_request = None
+
+    assert client.get(url("/")).text == "YOLO"
+    assert calls == ["outer", "inner"]
+    assert outer.pipeline.middlewares == [inner]
+
+
+def test_async_hooks_are_refused_under_wsgi(app, client):
+    class AsyncHook(Middleware):
+        async def process_request(self, req):
+            pass
+
+    app.add_middleware(AsyncHook)
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    with pytest.raises(AssertionError, match="only supported under ASGI"):
+        client.get(url("/"))
+
+
+def test_process_exception_is_called_on_errors(app, client):
+    exceptions = []
+
+    class RecordErrors(Middleware):
+        def process_exception(self, req, exception):
+            exceptions.append(exception)
+
+    app.add_middleware(RecordErrors)
+
+    @app.route("/")
+    def index(req, resp):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        client.get(url("/"))
+
+    assert len(exceptions) == 1
+    assert str(exceptions[0]) == "boom"
+
+
+def test_adding_middleware_recompiles_pipeline(app, client):
+    calls = []
+
+    class Late(Middleware):
+        def process_request(self, req):
+            calls.append("late")
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    client.get(url("/"))
+    app.add_middleware(Late)
+    client.get(url("/"))
+
+    assert calls == ["late"]
+
+
+def test_compression_middleware_gzips_large_bodies(app, client):
+    app.add_middleware(CompressionMiddleware, min_size=100)
+
+    @app.route('/')
+    def index(req, res):
+        res.text = "YOLO" * 100
+
+    response = client.get(url('/'), headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) < 400
+    assert gzip.decompress(response.content) == b"YOLO" * 100
+
+
+def test_compression_middleware_falls_back_to_deflate(app, client):
+    app.add_middleware(CompressionMiddleware, min_size=100)
+
+    @app.route('/')
+    def index(req, res):
+        res.json = {"items": list(range(100))}
+
+    response = client.get(url('/'), headers={"Accept-Encoding": "deflate, gzip;q=0"})
+
+    assert response.headers["Content-Encoding"] == "deflate"
+    assert json.loads(zlib.decompress(response.content)) == {"items": list(range(100))}
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, body, content_type",
+    [
+        ("identity", "YOLO" * 100, "text/plain"),
+        ("gzip", "YOLO", "text/plain"),
+        ("gzip", "YOLO" * 100, "application/octet-stream"),
+    ]
+)
+def test_compression_middleware_skips_responses(app, client, accept_encoding, body, content_type):
+    app.add_middleware(CompressionMiddleware, min_size=100)
+
+    @app.route('/')
+    def index(req, res):
+        res.body = body.encode()
+        res.content_type = content_type
+
+    response = client.get(url('/'), headers={"Accept-Encoding": accept_encoding})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.content == body.encode()
+
+
+def test_compression_middleware_weakens_strong_etags(app, client):
+    app.add_middleware(CompressionMiddleware)
+
+    @app.route("/big")
+    def big(req, res):
+        res.etag = "v1"
+        res.text = "x" * 1000
+
+    gzipped = client.get(url("/big"), headers={"Accept-Encoding": "gzip"})
+    plain = client.get(url("/big"), headers={"Accept-Encoding": "identity"})
+    revalidated = client.get(url("/big"), headers={"Accept-Encoding": "gzip", "If-None-Match": 'W/"v1"'})
+
+    assert gzipped.headers["ETag"] == 'W/"v1"'
+    assert plain.headers["ETag"] == '"v1"'
+    assert revalidated.status_code == 304
+
+
+def test_compression_middleware_caches_compressed_bodies(app, client):
+    app.add_middleware(CompressionMiddleware, min_size=100)
+    middleware = app._middleware.app
+
+    @app.route('/')
+    def index(req, res):
+        res.html = "<p>YOLO</p>" * 100
+
+    client.get(url('/'), headers={"Accept-Encoding": "gzip"})
+    response = client.get(url('/'), headers={"Accept-Encoding": "gzip"})
+
+    assert gzip.decompress(response.content) == b"<p>YOLO</p>" * 100
+    assert middleware.cache.misses == 1
+    assert middleware.cache.hits == 1
+
+
+def test_cache_middleware_caches_opted_in_routes(app, client):
+    app.add_middleware(CacheMiddleware)
+    calls = []
+
+    @app.route('/cached', cache=True)
+    def cached(req, res):
+        calls.append(req.path)
+        res.text = f"call {len(calls)}"
+        res.headers["X-Answer"] = "42"
+
+    @app.route('/fresh')
+    def fresh(req, res):
+        calls.append(req.path)
+        res.text = "fresh"
+
+    assert client.get(url('/cached')).text == "call 1"
+    response = client.get(url('/cached'))
+    client.get(url('/fresh'))
+    client.get(url('/fresh'))
+
+    assert response.text == "call 1"
+    assert response.headers["X-Answer"] == "42"
+    assert "Age" in response.headers
+    assert calls == ['/cached', '/fresh', '/fresh']
+
+
+def test_cache_middleware_cache_all_with_opt_out(app, client):
+    app.add_middleware(CacheMiddleware, cache_all=True)
+    calls = []
+
+    @app.route('/cached')
+    def cached(req, res):
+        calls.append(req.path)
+        res.text = "cached"
+
+    @app.route('/fresh', cache=False)
+    def fresh(req, res):
+        calls.append(req.path)
+        res.text = "fresh"
+
+    for _ in range(2):
+        client.get(url('/cached'))
+        client.get(url('/fresh'))
+
+    assert calls == ['/cached', '/fresh', '/fresh']
+
+
+def test_cache_middleware_key_includes_query_and_vary_headers(app, client):
+    app.add_middleware(CacheMiddleware, vary=["Accept-Language"])
+
+    @app.route('/greet', cache=True)
+    def greet(req, res):
+        res.text = f"{req.headers.get('Accept-Language')} {req.GET.get('name')}"
+
+    assert client.get(url('/greet?name=a'), headers={"Accept-Language": "en"}).text == "en a"
+    assert client.get(url('/greet?name=b'), headers={"Accept-Language": "en"}).text == "en b"
+    assert client.get(url('/greet?name=a'), headers={"Accept-Language": "fr"}).text == "fr a"
+    assert client.get(url('/greet?name=a'), headers={"Accept-Language": "en"}).text == "en a"
+
+
+def test_cache_middleware_respects_response_vary(app, client):
+    calls = 0
+    app.add_middleware(CompressionMiddleware)
+    app.add_middleware(CacheMiddleware, cache_all=True)
+
+    @app.route("/big")
+    def big(req, res):
+        nonlocal calls
+        calls += 1
+        res.text = "x" * 1000
+
+    gzipped = client.get(url("/big"), headers={"Accept-Encoding": "gzip"})
+    plain = client.get(url("/big"), headers={"Accept-Encoding": "identity"})
+    gzipped_again = client.get(url("/big"), headers={"Accept-Encoding": "gzip"})
+
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in plain.headers
+    assert plain.content == b"x" * 1000
+    assert gzipped_again.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(gzipped_again.content) == b"x" * 1000
+    assert calls == 2
+
+
+def test_cache_middleware_entries_expire(app, client, monkeypatch):
+    app.add_middleware(CacheMiddleware)
+    calls = []
+    now = [1000.0]
+    monkeypatch.setattr("alcazar.middleware.time.monotonic", lambda: now[0])
+
+    @app.route('/cached', cache=30)
+    def cached(req, res):
+        calls.append(True)
+        res.text = "cached"
+
+    client.get(url('/cached'))
+    now[0] += 29
+    client.get(url('/cached'))
+    now[0] += 2
+    client.get(url('/cached'))
+
+    assert len(calls) == 2
+
+
+def test_cache_middleware_skips_unsafe_methods_and_uncacheable_responses(app, client):
+    app.add_middleware(CacheMiddleware, cache_all=True)
+    calls = []
+
+    @app.route('/book')
+    def book(req, res):
+        calls.append(req.method)
+        res.text = "book"
+
+    @app.route('/private')
+    def private(req, res):
+        calls.append("private")
+        res.text = "private"
+        res.headers["Cache-Control"] = "private"
+
+    client.post(url('/book'))
+    client.post(url('/book'))
+    client.get(url('/private'))
+    client.get(url('/private'))
+
+    assert calls == ["POST", "POST", "private", "private"]
+
+
+def test_cache_middleware_runs_handler_once_for_concurrent_cold_requests(app):
+    app.add_middleware(CacheMiddleware)
+    client = app.session()
+    calls = []
+
+    @app.route('/slow', cache=True)
+    def slow(req, res):
+        calls.append(True)
+        time.sleep(0.1)
+        res.text = "slow"
+
+    results = []
+
+    def fetch():
+        results.append(client.get(url('/slow')).text)
+
+    threads = [threading.Thread(target=fetch) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["slow"] * 5
+    assert len(calls) == 1
+
+
+def test_profiling_middleware_samples_signed_requests(app, client, tmp_path):
+    app.add_middleware(ProfilingMiddleware, output_dir=str(tmp_path), secret="s3cret", interval=0.001)
+
+    @app.route("/users/{id}")
+    def user(req, resp, id):
+        time.sleep(0.05)
+        resp.text = id
+
+    client.get(url("/users/1"), headers={"X-Alcazar-Profile": profile_token("s3cret", "/users/1")})
+    client.get(url("/users/2?_profile=" + profile_token("s3cret", "/users/2")))
+
+    profiler = app._middleware.app
+    collapsed = profiler.stacks.collapsed("/users/{id}")
+    assert "user (" in collapsed
+    # stacks start below the middleware pipeline
+    assert collapsed.startswith("dispatch_request (")
+    assert (tmp_path / "users_id.folded").read_text() == collapsed
+
+
+def test_profiling_middleware_samples_handler_threads_under_asgi(app):
+    app.add_middleware(ProfilingMiddleware, sample_rate=1.0, interval=0.001)
+
+    def spin(seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    @app.route("/sync")
+    def sync_handler(req, resp):
+        spin(0.05)
+        resp.text = "sync"
+
+    @app.route("/async")
+    async def async_handler(req, resp):
+        spin(0.05)
+        await asyncio.sleep(0.05)
+        resp.text = "async"
+
+    assert asgi_request(app, "GET", "/sync")[2] == b"sync"
+    assert asgi_request(app, "GET", "/async")[2] == b"async"
+
+    stacks = app._middleware.app.stacks
+    sync_stacks = stacks.stacks["/sync"]
+    assert any("sync_handler (" in stack and "spin (" in stack for stack in sync_stacks)
+    # only the handler's thread is sampled, not the event loop waiting for it
+    assert all("select" not in stack for stack in sync_stacks)
+    async_stacks = stacks.stacks["/async"]
+    assert any("async_handler (" in stack and "spin (" in stack for stack in async_stacks)
+    # while the handler is suspended the loop is idle, which is not part of the request
+    assert all(stack.startswith("async_handler (") for stack in async_stacks)
+
+
+def test_profiling_middleware_ignores_unsigned_requests(app, client):
+    app.add_middleware(ProfilingMiddleware, secret="s3cret")
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    client.get(url("/"), headers={"X-Alcazar-Profile": "forged"})
+    client.get(url("/?_profile=forged"))
+    assert client.get(url("/?_profile=%C3%A9")).text == "YOLO"
+
+    assert app._middleware.app.stacks.stacks == {}
+
+
+def test_profiling_middleware_samples_a_fraction_of_requests(app, client, monkeypatch):
+    app.add_middleware(ProfilingMiddleware, sample_rate=0.5, interval=0.001)
+    monkeypatch.setattr("alcazar.middleware.random.random", lambda: 0.25)
+
+    @app.route("/")
+    def index(req, resp):
+        time.sleep(0.02)
+        resp.text = "YOLO"
+
+    client.get(url("/"))
+
+    assert "index (" in app._middleware.app.stacks.collapsed("/")
+
+
+def test_profiling_middleware_ignores_non_ascii_tokens(app):
+    app.add_middleware(ProfilingMiddleware, secret="s3cret")
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    # headers are latin-1 on the wire, so a raw "é" reaches the app as non-ASCII text
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": "/", "SERVER_NAME": "testserver", "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http", "HTTP_X_ALCAZAR_PROFILE": "\u00e9",
+    }
+    started = {}
+    body = b"".join(app(environ, lambda status, headers, exc_info=None: started.update(status=status)))
+
+    assert started["status"] == "200 OK"
+    assert body == b"YOLO"
+    assert app._middleware.app.stacks.stacks == {}
@@ -3,7 +3,9 @@ import sqlite3
 
 import pytest
 
+from alcazar import Alcazar
 from alcazar.orm import Database, Table, Column, ForeignKey
+from alcazar.utils import url
 
 
 class Author(Table):
@@ -182,3 +184,257 @@ def test_delete_author(db):
 
     with pytest.raises(Exception):
         db.get(Author, 1)
+
+
+def test_table_metadata_is_collected_once(db, monkeypatch):
+    db.create(Author)
+    db.create(Book)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("inspect.getmembers called after class creation")
+
+    monkeypatch.setattr("alcazar.orm.inspect.getmembers", fail)
+
+    greg = Author(name="George", age=13)
+    db.save(greg)
+    book = Book(title="Building an ORM", published=False, author=greg)
+    db.save(book)
+    book.published = True
+    db.update(book)
+
+    book_from_db = db.get(Book, id=book.id)
+    assert book_from_db.published == 1
+    assert book_from_db.author.name == "George"
+    assert book._get_update_sql()[0] is Book._sql["update"]
+
+
+@pytest.fixture
+def library(db):
+    db.create(Author)
+    db.create(Book)
+
+    authors = [Author(name=f"Author {i}", age=30 + i) for i in range(3)]
+    for author in authors:
+        db.save(author)
+    for i in range(9):
+        db.save(Book(title=f"Book {i}", published=True, author=authors[i % 3]))
+
+    return db
+
+
+def count_queries(db):
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    return queries
+
+
+@pytest.mark.parametrize("related, expected_queries", [("prefetch", 2), ("join", 1)])
+def test_all_loads_foreign_keys_eagerly(library, related, expected_queries):
+    queries = count_queries(library)
+
+    books = library.all(Book, related=related)
+
+    assert len(queries) == expected_queries
+    assert len(books) == 9
+    assert {book.author.name for book in books} == {"Author 0", "Author 1", "Author 2"}
+    # each author is loaded once and shared by its books
+    assert books[0].author is books[3].author
+    assert len(queries) == expected_queries
+
+
+def test_all_loads_foreign_keys_lazily(library):
+    queries = count_queries(library)
+
+    books = library.all(Book, related="lazy")
+    assert len(queries) == 1
+
+    assert books[0].author.name == "Author 0"
+    assert books[0].author.age == 30
+    assert len(queries) == 2
+
+    # saving keeps the unloaded foreign key without fetching it
+    library.update(books[1])
+    assert not any("FROM author" in query for query in queries[2:])
+
+
+@pytest.mark.parametrize("related", ["prefetch", "join", "lazy"])
+def test_get_with_related_strategies(library, related):
+    book = library.get(Book, id=5, related=related)
+
+    assert book.title == "Book 4"
+    assert book.author.name == "Author 1"
+
+
+def test_get_with_join_raises_for_missing_rows(library):
+    with pytest.raises(Exception, match="Book instance with id 100 does not exist"):
+        library.get(Book, id=100, related="join")
+
+
+def test_bulk_save_sets_ids_and_commits_once(db):
+    db.create(Author)
+    db.create(Book)
+    db.save(Author(name="Existing", age=50))
+
+    authors = [Author(name=f"Author {i}", age=i) for i in range(5)]
+    books = [Book(title="Bulk", published=True, author=authors[0])]
+    queries = count_queries(db)
+
+    db.bulk_save(authors)
+    db.bulk_save(books)
+
+    assert [author.id for author in authors] == [2, 3, 4, 5, 6]
+    assert books[0].id == 1
+    assert queries.count("COMMIT") == 2
+    assert db.get(Author, id=4).name == "Author 2"
+    assert db.get(Book, id=1).author.name == "Author 0"
+
+
+def test_bulk_update_and_delete(db):
+    db.create(Author)
+    authors = [Author(name=f"Author {i}", age=i) for i in range(4)]
+    db.bulk_save(authors)
+
+    for author in authors:
+        author.age += 10
+    db.bulk_update(authors)
+    db.bulk_delete(Author, [authors[0].id, authors[1].id])
+
+    assert sorted(author.age for author in db.all(Author)) == [12, 13]
+
+
+def test_transaction_defers_commit_and_rolls_back(db):
+    db.create(Author)
+    queries = count_queries(db)
+
+    with db.transaction():
+        db.save(Author(name="First", age=1))
+        db.save(Author(name="Second", age=2))
+    assert queries.count("COMMIT") == 1
+
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.save(Author(name="Third", age=3))
+            raise ValueError()
+
+    assert [author.name for author in db.all(Author)] == ["First", "Second"]
+
+
+def test_nested_transactions_use_savepoints(db):
+    db.create(Author)
+
+    with db.transaction():
+        db.save(Author(name="Outer", age=1))
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.save(Author(name="Inner", age=2))
+                raise ValueError()
+        with db.transaction():
+            db.save(Author(name="Kept", age=3))
+
+    assert [author.name for author in db.all(Author)] == ["Outer", "Kept"]
+
+
+def test_query_compiles_to_a_single_select(library):
+    query = library.query(Book).filter(published=True, title__ne="Book 0").order_by("-id").limit(2).offset(1)
+
+    assert query._get_sql() == (
+        "SELECT id, author_id, published, title FROM book"
+        " WHERE book.published = ? AND book.title != ? ORDER BY book.id DESC LIMIT ? OFFSET ?",
+        [True, "Book 0", 2, 1],
+    )
+
+    queries = count_queries(library)
+    titles = [book.title for book in query]
+
+    assert titles == ["Book 7", "Book 6"]
+    assert len(queries) == 2  # the books and their authors
+
+
+def test_query_is_lazy_and_chainable(library):
+    queries = count_queries(library)
+
+    base = library.query(Book)
+    recent = base.filter(id__gte=5)
+    assert queries == []
+
+    assert len(base.all()) == 9
+    assert len(recent.all()) == 5
+    assert [book.id for book in recent.filter(id__lt=7)] == [5, 6]
+
+
+def test_query_operators(library):
+    def ids(**conditions):
+        return [book.id for book in library.query(Book).filter(**conditions).order_by("id")]
+
+    assert ids(id__in=[2, 4, 100]) == [2, 4]
+    assert ids(id__in=[]) == []
+    assert ids(id__lte=2) == [1, 2]
+    assert ids(id__gt=8) == [9]
+    assert ids(id=3) == [3]
+
+
+def test_query_filters_on_foreign_keys(library):
+    author = library.get(Author, id=2)
+
+    assert [book.id for book in library.query(Book).filter(author=author)] == [2, 5, 8]
+    assert [book.id for book in library.query(Book).filter(author__in=[1, author])] == [1, 2, 4, 5, 7, 8]
+    assert [book.title for book in library.query(Book).filter(author__name="Author 2", id__gt=3)] == ["Book 5", "Book 8"]
+    assert [book.id for book in library.query(Book).filter(author__age__gte=32).order_by("-title")] == [9, 6, 3]
+
+
+def test_query_first_and_related_strategies(library):
+    book = library.query(Book).filter(author__name="Author 1").order_by("-id").related("join").first()
+
+    assert book.title == "Book 7"
+    assert book.author.name == "Author 1"
+    assert library.query(Book).filter(id=100).first() is None
+    assert library.query(Book).offset(8).related("lazy").all()[0].author.name == "Author 2"
+
+
+def test_iterate_fetches_in_chunks(library):
+    queries = count_queries(library)
+
+    books = library.iterate(Book, chunk_size=4)
+    first = next(books)
+
+    assert first.title == "Book 0"
+    assert first.author.name == "Author 0"
+    # the books query and the authors of the first chunk only
+    assert len(queries) == 2
+
+    rest = list(books)
+    assert [book.id for book in rest] == list(range(2, 10))
+    assert len(queries) == 4
+    assert rest[-1].author.name == "Author 2"
+
+
+@pytest.mark.parametrize("related", ["join", "lazy"])
+def test_iterate_with_related_strategies(library, related):
+    books = list(library.iterate(Book, chunk_size=2, related=related))
+
+    assert len(books) == 9
+    assert books[4].author.name == "Author 1"
+
+
+def test_query_iterate(library):
+    query = library.query(Book).filter(published=True).order_by("-id").limit(5)
+
+    assert [book.id for book in query.iterate(chunk_size=2)] == [9, 8, 7, 6, 5]
+
+
+def test_to_dict(library):
+    book = library.get(Book, id=1, related="lazy")
+
+    assert book.to_dict() == {"id": 1, "author_id": 1, "published": 1, "title": "Book 0"}
+
+
+def test_iterate_as_streaming_response_body(library):
+    app = Alcazar(templates_dir="tests/templates", debug=False)
+
+    @app.route("/books.json")
+    def export(req, resp):
+        resp.stream_json(book.to_dict() for book in library.iterate(Book, chunk_size=3))
+
+    response = app.session().get(url("/books.json"))
+
+    assert [book["title"] for book in response.json()] == [f"Book {i}" for i in range(9)]
@@ -0,0 +1,144 @@
+import io
+
+import pytest
+from webob import Request as WebObRequest
+from webob.multidict import MultiDict
+
+from alcazar.middleware import Middleware
+from alcazar.requests import Request
+from alcazar.utils.tests import url
+
+
+def make_environ(**overrides):
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": "/books",
+        "QUERY_STRING": "",
+        "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(b""),
+    }
+    environ.update(overrides)
+    return environ
+
+
+def test_request_basic_attributes():
+    req = Request(make_environ(QUERY_STRING="page=2", HTTP_HOST="example.com"))
+
+    assert req.method == "GET"
+    assert req.path == "/books"
+    assert req.host == "example.com"
+    assert req.url == "http://example.com/books?page=2"
+
+
+def test_non_ascii_paths_match_webob():
+    environ = make_environ(
+        SCRIPT_NAME="/caf\u00e9".encode("utf-8").decode("latin-1"),
+        PATH_INFO="/u/Jos\u00e9 Mar\u00eda".encode("utf-8").decode("latin-1"),
+    )
+    req, webob_req = Request(environ), WebObRequest(environ)
+
+    assert req.path_info == webob_req.path_info == "/u/Jos\u00e9 Mar\u00eda"
+    assert req.script_name == webob_req.script_name == "/caf\u00e9"
+    assert req.path == webob_req.path == "/caf%C3%A9/u/Jos%C3%A9%20Mar%C3%ADa"
+    assert req.application_url == webob_req.application_url
+    assert req.path_url == webob_req.path_url
+    assert req.url == webob_req.url
+
+
+def test_request_has_no_instance_dict():
+    req = Request(make_environ())
+    req.unknown = True
+
+    assert not hasattr(req, "__dict__")
+    assert req.environ["webob.adhoc_attrs"] == {"unknown": True}
+
+
+def test_query_string_is_parsed_lazily_and_cached():
+    req = Request(make_environ(QUERY_STRING="tag=orm&tag=web&page=2&empty="))
+
+    assert not isinstance(req._GET, MultiDict)
+    assert req.GET.getall("tag") == ["orm", "web"]
+    assert req.GET["page"] == "2"
+    assert req.GET["empty"] == ""
+    assert req.GET is req.GET
+
+
+def test_headers_and_cookies():
+    req = Request(make_environ(HTTP_USER_AGENT="pytest", HTTP_COOKIE="session=abc; theme=dark", CONTENT_TYPE="text/plain"))
+
+    assert req.headers["User-Agent"] == "pytest"
+    assert req.headers["content-type"] == "text/plain"
+    assert req.cookies == {"session": "abc", "theme": "dark"}
+
+
+def test_body_text_and_json():
+    body = b'{"name": "alcazar"}'
+    req = Request(make_environ(REQUEST_METHOD="POST", CONTENT_LENGTH=str(len(body)), CONTENT_TYPE="application/json",
+                               **{"wsgi.input": io.BytesIO(body)}))
+
+    assert req.body == body
+    assert req.text == body.decode()
+    assert req.json == {"name": "alcazar"}
+    assert req.body is req.body
+
+
+def test_urlencoded_form():
+    body = b"title=ORM&published=1"
+    req = Request(make_environ(REQUEST_METHOD="POST", CONTENT_LENGTH=str(len(body)),
+                               CONTENT_TYPE="application/x-www-form-urlencoded; charset=UTF-8",
+                               QUERY_STRING="page=2", **{"wsgi.input": io.BytesIO(body)}))
+
+    assert req.POST["title"] == "ORM"
+    assert req.params["page"] == "2"
+    assert req.params["published"] == "1"
+
+
+def test_unknown_attributes_fall_back_to_webob():
+    req = Request(make_environ(HTTP_USER_AGENT="pytest", HTTP_REFERER="http://example.com/"))
+
+    assert req.user_agent == "pytest"
+    assert req.referer == "http://example.com/"
+
+
+def test_handlers_receive_lightweight_request(app, client):
+    @app.route("/search")
+    def search(req, resp):
+        assert isinstance(req, Request)
+        resp.json = {"q": req.GET["q"], "form": req.POST["title"]}
+
+    response = client.post(url("/search?q=orm"), data={"title": "Building an ORM"})
+
+    assert response.json() == {"q": "orm", "form": "Building an ORM"}
+
+
+def test_adhoc_attributes_are_kept_in_environ():
+    environ = make_environ()
+    req = Request(environ)
+
+    req.user = "george"
+
+    assert req.user == "george"
+    assert environ["webob.adhoc_attrs"] == {"user": "george"}
+    assert Request(environ).user == "george"
+    assert WebObRequest(environ).user == "george"
+
+    del req.user
+    with pytest.raises(AttributeError):
+        req.user
+
+
+def test_middleware_can_set_request_attributes(app, client):
+    class Auth(Middleware):
+        def process_request(self, req):
+            req.user = req.headers.get("X-User")
+
+    app.add_middleware(Auth)
+
+    @app.route("/me")
+    def me(req, resp):
+        resp.text = req.user
+
+    assert client.get(url("/me"), headers={"X-User": "george"}).text == "george"
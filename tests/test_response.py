@@ -1,3 +1,7 @@
+import pytest
+
+import alcazar
+from alcazar.responses import Response, WebObCompatResponse, status_line
 from alcazar.utils.tests import url
 
 
@@ -57,3 +61,184 @@ def test_status_code(app, client):
         resp.status_code = 215
 
     assert client.get(url("/cool")).status_code == 215
+
+
+def test_streaming_response(app, client):
+    produced = []
+
+    def rows():
+        for i in range(3):
+            produced.append(i)
+            yield f"row {i}\n"
+
+    @app.route("/export")
+    def export(req, resp):
+        resp.stream = rows()
+        resp.content_type = "text/csv"
+
+    response = client.get(url("/export"))
+
+    assert response.text == "row 0\nrow 1\nrow 2\n"
+    assert "text/csv" in response.headers["Content-Type"]
+    assert "Content-Length" not in response.headers
+    assert produced == [0, 1, 2]
+
+
+def test_streaming_response_is_not_consumed_by_handler(app):
+    consumed = []
+
+    def rows():
+        consumed.append(True)
+        yield b"row"
+
+    @app.route("/export")
+    def export(req, resp):
+        resp.stream = rows()
+
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/export", "SERVER_NAME": "testserver",
+               "SERVER_PORT": "80", "wsgi.url_scheme": "http"}
+    body = app(environ, lambda status, headers, exc_info=None: None)
+
+    assert consumed == []
+    assert list(body) == [b"row"]
+
+
+@pytest.fixture
+def report(tmp_path):
+    path = tmp_path / "report.csv"
+    path.write_bytes(b"0123456789" * 10)
+    return path
+
+
+def test_file_response(app, client, report):
+    @app.route("/report")
+    def send_report(req, resp):
+        resp.file(str(report))
+
+    response = client.get(url("/report"))
+
+    assert response.status_code == 200
+    assert "text/csv" in response.headers["Content-Type"]
+    assert response.headers["Content-Length"] == "100"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.content == b"0123456789" * 10
+
+
+def test_file_response_from_file_object(app, client, report):
+    @app.route("/report")
+    def send_report(req, resp):
+        resp.file(open(report, "rb"), content_type="text/plain")
+
+    response = client.get(url("/report"))
+
+    assert "text/plain" in response.headers["Content-Type"]
+    assert response.content == b"0123456789" * 10
+
+
+def test_file_response_uses_wsgi_file_wrapper(app, report):
+    wrapped = []
+
+    def file_wrapper(fileobj, block_size):
+        wrapped.append(fileobj)
+        return iter(lambda: fileobj.read(block_size), b"")
+
+    @app.route("/report")
+    def send_report(req, resp):
+        resp.file(str(report))
+
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/report", "SERVER_NAME": "testserver",
+               "SERVER_PORT": "80", "wsgi.url_scheme": "http", "wsgi.file_wrapper": file_wrapper}
+    body = app(environ, lambda status, headers, exc_info=None: None)
+
+    assert len(wrapped) == 1
+    assert b"".join(body) == b"0123456789" * 10
+
+
+@pytest.mark.parametrize(
+    "range_header, content_range, content",
+    [
+        ("bytes=10-14", "bytes 10-14/100", b"01234"),
+        ("bytes=95-", "bytes 95-99/100", b"56789"),
+        ("bytes=-3", "bytes 97-99/100", b"789"),
+        ("bytes=98-200", "bytes 98-99/100", b"89"),
+    ]
+)
+def test_file_response_range_request(app, client, report, range_header, content_range, content):
+    @app.route("/report")
+    def send_report(req, resp):
+        resp.file(str(report))
+
+    response = client.get(url("/report"), headers={"Range": range_header})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == content_range
+    assert response.content == content
+
+
+def test_file_response_unsatisfiable_range(app, client, report):
+    @app.route("/report")
+    def send_report(req, resp):
+        resp.file(str(report))
+
+    response = client.get(url("/report"), headers={"Range": "bytes=100-"})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+
+def test_custom_headers(app, client):
+    @app.route("/headers")
+    def with_headers(req, resp):
+        resp.text = "headers"
+        resp.headers["X-Powered-By"] = "alcazar"
+        resp.headers["Cache-Control"] = "no-store"
+
+    response = client.get(url("/headers"))
+
+    assert response.headers["X-Powered-By"] == "alcazar"
+    assert response.headers["Cache-Control"] == "no-store"
+    assert response.headers["Content-Length"] == "7"
+
+
+def test_response_has_no_instance_dict():
+    with pytest.raises(AttributeError):
+        Response().unknown = True
+
+
+@pytest.mark.parametrize(
+    "status_code, line",
+    [
+        (200, "200 OK"),
+        (404, "404 Not Found"),
+        (215, "215 Success"),
+    ]
+)
+def test_status_line(status_code, line):
+    assert status_line(status_code) == line
+
+
+def test_head_request_has_no_body(app, client):
+    @app.route("/text")
+    def text_handler(req, resp):
+        resp.text = "Just Plain Text"
+
+    response = client.head(url("/text"))
+
+    assert response.headers["Content-Length"] == "15"
+    assert response.content == b""
+
+
+def test_webob_compat_response():
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, response_class=WebObCompatResponse)
+    client = app.session()
+
+    @app.route("/text")
+    def text_handler(req, resp):
+        resp.text = "Just Plain Text"
+        resp.headers["X-Powered-By"] = "alcazar"
+
+    response = client.get(url("/text"))
+
+    assert "text/plain" in response.headers["Content-Type"]
+    assert response.headers["X-Powered-By"] == "alcazar"
+    assert response.text == "Just Plain Text"
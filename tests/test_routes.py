@@ -1,5 +1,6 @@
 import pytest
 
+import alcazar
 from alcazar.utils.tests import url
 
 
@@ -53,3 +54,95 @@ def test_class_based_handler_route_registration(app):
     class BookResource:
         def get(self, req, resp):
             resp.text = "yolo"
+
+
+def test_typed_parameterized_route(app, client):
+    @app.route("/books/{id:d}")
+    def book(req, resp, id):
+        resp.text = f"book {id + 1}"
+
+    assert client.get(url("/books/41")).text == "book 42"
+
+
+def test_first_added_route_wins(app, client):
+    @app.route("/{age:d}")
+    def age(req, resp, age):
+        resp.text = f"age {age}"
+
+    @app.route("/{name}")
+    def name(req, resp, name):
+        resp.text = f"name {name}"
+
+    assert client.get(url("/23")).text == "age 23"
+    assert client.get(url("/john")).text == "name john"
+
+
+def test_static_segment_does_not_shadow_earlier_parameterized_route(app, client):
+    @app.route("/{name}/profile")
+    def profile(req, resp, name):
+        resp.text = f"profile of {name}"
+
+    @app.route("/me/profile")
+    def my_profile(req, resp):
+        resp.text = "my profile"
+
+    assert client.get(url("/me/profile")).text == "profile of me"
+
+
+def test_find_route_returns_route_and_kwargs(app):
+    @app.route("/authors/{author_id:d}/books/{title}")
+    def book(req, resp, author_id, title):
+        pass
+
+    route, kwargs = app.find_route("/authors/7/books/orm")
+
+    assert route is app._routes["/authors/{author_id:d}/books/{title}"]
+    assert kwargs == {"author_id": 7, "title": "orm"}
+    assert app.find_route("/authors/x/books/orm") == (None, {})
+    assert app.find_route("/authors/7/books") == (None, {})
+
+
+def test_route_cache_counts_hits_and_misses():
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, route_cache_size=2)
+    client = app.session()
+
+    @app.route("/{name}")
+    def hello(req, resp, name):
+        resp.text = f"hey {name}"
+
+    assert client.get(url("/matthew")).text == "hey matthew"
+    assert client.get(url("/matthew")).text == "hey matthew"
+    assert app.route_cache.hits == 1
+    assert app.route_cache.misses == 1
+
+
+def test_route_cache_evicts_least_recently_used_path():
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, route_cache_size=2)
+
+    @app.route("/{name}")
+    def hello(req, resp, name):
+        pass
+
+    app.find_route("/a")
+    app.find_route("/b")
+    app.find_route("/a")
+    app.find_route("/c")
+
+    assert len(app.route_cache) == 2
+    app.find_route("/a")
+    assert app.route_cache.hits == 2
+    app.find_route("/b")
+    assert app.route_cache.misses == 4
+
+
+def test_route_cache_is_invalidated_when_route_is_added():
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, route_cache_size=10)
+
+    assert app.find_route("/about") == (None, {})
+
+    @app.route("/about")
+    def about(req, resp):
+        pass
+
+    route, kwargs = app.find_route("/about")
+    assert route is app._routes["/about"]
@@ -0,0 +1,251 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+import alcazar
+from alcazar.__main__ import main
+from alcazar.static import StaticFiles, collect_static
+from alcazar.utils.tests import url, asgi_request
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "main.css").write_text("body { color: red; }")
+    (tmp_path / "big.bin").write_bytes(b"0123456789" * 1000)
+    return tmp_path
+
+
+@pytest.fixture
+def static_app(static_dir):
+    return alcazar.Alcazar(templates_dir="tests/templates", static_dir=str(static_dir), debug=False)
+
+
+def test_static_files_are_indexed_once(static_dir):
+    static = StaticFiles(str(static_dir), max_memory_size=100)
+
+    assert set(static.files) == {"/css/main.css", "/big.bin"}
+    # small files are only read into memory when first requested
+    assert static.files["/css/main.css"].content is None
+    assert static.files["/css/main.css"].load_content() == b"body { color: red; }"
+    assert static.files["/css/main.css"].content == b"body { color: red; }"
+    assert static.files["/big.bin"].load_content() is None
+
+
+def test_serve_static_file(static_app):
+    client = static_app.session()
+
+    response = client.get(url("/static/css/main.css"))
+
+    assert response.status_code == 200
+    assert response.text == "body { color: red; }"
+    assert response.headers["Content-Type"] == "text/css; charset=utf-8"
+    assert response.headers["Content-Length"] == "20"
+    assert "ETag" in response.headers
+    assert "Last-Modified" in response.headers
+
+
+def test_missing_static_file(static_app):
+    client = static_app.session()
+
+    assert client.get(url("/static/nope.css")).status_code == 404
+
+
+def test_autorefresh_does_not_serve_files_outside_root(static_dir):
+    (static_dir.parent / "secret.txt").write_text("secret")
+    static = StaticFiles(str(static_dir), autorefresh=True)
+
+    assert static.find_file("/../secret.txt") is None
+    assert static.find_file("/css/main.css") is not None
+
+
+def test_autorefresh_caches_gzipped_variants(static_dir):
+    static = StaticFiles(str(static_dir), autorefresh=True)
+    assert static.find_file("/css/main.css").gzipped is None
+
+    (static_dir / "css" / "main.css.gz").write_bytes(gzip.compress(b"body { color: red; }"))
+    gzipped = static.find_file("/css/main.css").gzipped
+    assert gzipped is not None
+    assert static.find_file("/css/main.css").gzipped is gzipped
+
+    (static_dir / "css" / "main.css.gz").unlink()
+    assert static.find_file("/css/main.css").gzipped is None
+
+
+def test_autorefresh_does_not_serve_directories(static_dir):
+    static = StaticFiles(str(static_dir), autorefresh=True)
+    responses = []
+
+    body = static({"REQUEST_METHOD": "GET", "PATH_INFO": "/css"}, lambda status, headers: responses.append(status))
+
+    assert static.find_file("/css") is None
+    assert responses == ["404 Not Found"]
+    assert body == [b"Not Found"]
+
+
+def test_static_file_conditional_request(static_app):
+    client = static_app.session()
+    etag = client.get(url("/static/css/main.css")).headers["ETag"]
+
+    response = client.get(url("/static/css/main.css"), headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+@pytest.mark.parametrize("max_memory_size", [0, 1024 * 1024])
+def test_static_file_range_request(static_dir, max_memory_size):
+    app = alcazar.Alcazar(templates_dir="tests/templates", static_dir=str(static_dir), debug=False)
+    app.static = StaticFiles(str(static_dir), max_memory_size=max_memory_size)
+    client = app.session()
+
+    response = client.get(url("/static/big.bin"), headers={"Range": "bytes=10-14"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-14/10000"
+    assert response.content == b"01234"
+
+    response = client.get(url("/static/big.bin"))
+
+    assert response.content == b"0123456789" * 1000
+
+
+def test_static_files_added_later_are_not_served_without_autorefresh(static_app, static_dir):
+    client = static_app.session()
+    (static_dir / "new.js").write_text("alert(1);")
+
+    assert client.get(url("/static/new.js")).status_code == 404
+
+
+def test_static_autorefresh(static_dir):
+    app = alcazar.Alcazar(templates_dir="tests/templates", static_dir=str(static_dir), debug=False,
+                          static_autorefresh=True)
+    client = app.session()
+
+    assert app.static.files == {}
+
+    (static_dir / "new.js").write_text("alert(1);")
+    assert client.get(url("/static/new.js")).text == "alert(1);"
+    assert set(app.static.files) == {"/new.js"}
+
+    (static_dir / "new.js").write_text("alert(12);")
+    assert client.get(url("/static/new.js")).text == "alert(12);"
+
+
+def test_static_file_through_asgi(static_app):
+    status, headers, body = asgi_request(static_app, "get", "/static/css/main.css")
+
+    assert status == 200
+    assert body == b"body { color: red; }"
+
+
+def test_large_static_file_is_streamed_through_asgi(static_app, static_dir):
+    static_app.static = StaticFiles(str(static_dir), max_memory_size=100)
+    scope = {"type": "http", "method": "GET", "path": "/static/big.bin", "headers": []}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(static_app.asgi(scope, receive, send))
+
+    assert sent[0]["status"] == 200
+    assert sent[1] == {"type": "http.response.body", "body": b"0123456789" * 1000, "more_body": True}
+    assert sent[-1] == {"type": "http.response.body", "body": b""}
+
+
+@pytest.fixture
+def collected_static_dir(static_dir):
+    (static_dir / "css" / "main.css").write_text("body { color: red; }\n" * 50)
+    collect_static(str(static_dir))
+    return static_dir
+
+
+def test_collect_static_writes_hashed_files_and_manifest(static_dir):
+    (static_dir / "css" / "main.css").write_text("body { color: red; }\n" * 50)
+
+    manifest = collect_static(str(static_dir))
+
+    hashed = manifest["css/main.css"]
+    assert hashed.startswith("css/main.") and hashed.endswith(".css")
+    assert (static_dir / hashed).read_bytes() == (static_dir / "css" / "main.css").read_bytes()
+    assert gzip.decompress((static_dir / (hashed + ".gz")).read_bytes()) == (static_dir / hashed).read_bytes()
+    assert not (static_dir / (manifest["big.bin"] + ".gz")).exists()
+    assert json.loads((static_dir / "staticfiles.json").read_text())["paths"] == manifest
+
+
+def test_collect_static_is_idempotent_in_place(collected_static_dir):
+    first = json.loads((collected_static_dir / "staticfiles.json").read_text())["paths"]
+
+    assert collect_static(str(collected_static_dir)) == first
+
+
+def test_collect_static_skips_its_own_outputs_across_runs(collected_static_dir):
+    (collected_static_dir / "data.tar.gz").write_bytes(b"archive")
+    collect_static(str(collected_static_dir))
+    files = sorted(path for path in collected_static_dir.glob("**/*") if path.is_file())
+
+    third = collect_static(str(collected_static_dir))
+
+    assert sorted(third) == ["big.bin", "css/main.css", "data.tar.gz"]
+    assert sorted(path for path in collected_static_dir.glob("**/*") if path.is_file()) == files
+
+    # files generated for an older version of a source are not collected either
+    (collected_static_dir / "css" / "main.css").write_text("body { color: blue; }\n" * 50)
+    collect_static(str(collected_static_dir))
+    assert sorted(collect_static(str(collected_static_dir))) == ["big.bin", "css/main.css", "data.tar.gz"]
+
+
+def test_collect_static_to_output_dir(static_dir, tmp_path_factory):
+    output_dir = tmp_path_factory.mktemp("collected")
+
+    manifest = collect_static(str(static_dir), output_dir=str(output_dir))
+
+    assert (output_dir / "css" / "main.css").exists()
+    assert (output_dir / manifest["css/main.css"]).exists()
+    assert not (static_dir / "staticfiles.json").exists()
+
+
+def test_collectstatic_command(static_dir, capsys):
+    main(["collectstatic", "--static-dir", str(static_dir), "--no-compress"])
+
+    assert "2 static files collected." in capsys.readouterr().out
+    assert not list(static_dir.glob("**/*.gz"))
+
+
+def test_static_url_uses_hashed_names(collected_static_dir):
+    app = alcazar.Alcazar(templates_dir="tests/templates", static_dir=str(collected_static_dir), debug=False)
+    manifest = json.loads((collected_static_dir / "staticfiles.json").read_text())["paths"]
+
+    assert app.static_url("css/main.css") == "/static/" + manifest["css/main.css"]
+    assert app.static_url("/unknown.js") == "/static/unknown.js"
+    assert app.templates.from_string("{{ static('css/main.css') }}").render() == "/static/" + manifest["css/main.css"]
+
+
+def test_hashed_files_are_served_immutable_and_precompressed(collected_static_dir):
+    app = alcazar.Alcazar(templates_dir="tests/templates", static_dir=str(collected_static_dir), debug=False)
+    client = app.session()
+    hashed_url = url(app.static_url("css/main.css"))
+
+    response = client.get(hashed_url, headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Cache-Control"] == "max-age=31536000, public, immutable"
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Type"] == "text/css; charset=utf-8"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.content) == b"body { color: red; }\n" * 50
+
+    response = client.get(hashed_url, headers={"Accept-Encoding": "identity"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.content == b"body { color: red; }\n" * 50
+
+    response = client.get(url("/static/css/main.css"), headers={"Accept-Encoding": "identity"})
+
+    assert response.headers["Cache-Control"] == "max-age=60, public"
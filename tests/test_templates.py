@@ -0,0 +1,121 @@
+import alcazar
+from alcazar.templates import get_templates_env, compile_templates
+from alcazar.utils.tests import url
+
+
+def test_precompile_templates_fills_bytecode_cache(tmp_path):
+    cache_dir = tmp_path / "bytecode"
+
+    app = alcazar.Alcazar(templates_dir="tests/templates", templates_cache_dir=str(cache_dir), precompile_templates=True)
+
+    assert len(list(cache_dir.iterdir())) == 1
+    assert "Best Title" in app.template("example.html", context={"title": "Best Title"})
+
+
+def test_precompile_templates_skips_other_files(tmp_path):
+    (tmp_path / "page.html").write_text("<p>{{ body }}</p>")
+    (tmp_path / "mail.txt").write_text("Hi {{ name }}")
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\n\xff\xfe")
+    (tmp_path / ".page.html.swp").write_bytes(b"\xff\xfe\x00")
+
+    app = alcazar.Alcazar(templates_dir=str(tmp_path), precompile_templates=True)
+
+    assert compile_templates(app.templates) == ["mail.txt", "page.html"]
+    assert compile_templates(app.templates, extensions=["html"]) == ["page.html"]
+    assert alcazar.Alcazar(templates_dir=str(tmp_path), precompile_templates=["txt"]).template(
+        "mail.txt", context={"name": "George"}
+    ) == "Hi George"
+
+
+def test_bytecode_cache_is_shared_between_environments(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "bytecode")
+    compile_templates(get_templates_env("tests/templates", bytecode_cache_dir=cache_dir))
+
+    env = get_templates_env("tests/templates", bytecode_cache_dir=cache_dir)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("template should have been loaded from the bytecode cache")
+
+    monkeypatch.setattr(env, "compile", fail)
+    assert compile_templates(env) == ["example.html"]
+
+
+def test_fragment_cache_renders_once(app):
+    calls = []
+
+    def expensive():
+        calls.append(True)
+        return f"menu {len(calls)}"
+
+    template = app.templates.from_string("{% cache 'menu' %}{{ expensive() }}{% endcache %}|{{ name }}")
+
+    assert template.render(expensive=expensive, name="a") == "menu 1|a"
+    assert template.render(expensive=expensive, name="b") == "menu 1|b"
+    assert len(calls) == 1
+
+
+def test_fragment_cache_key_can_be_an_expression(app):
+    template = app.templates.from_string("{% cache 'user-' ~ user, 60 %}{{ user }}{% endcache %}")
+
+    assert template.render(user="a") == "a"
+    assert template.render(user="b") == "b"
+
+
+def test_fragment_cache_expires(app, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("alcazar.templates.time.monotonic", lambda: now[0])
+    template = app.templates.from_string("{% cache 'clock', 10 %}{{ value }}{% endcache %}")
+
+    assert template.render(value=1) == "1"
+    now[0] += 9
+    assert template.render(value=2) == "1"
+    now[0] += 2
+    assert template.render(value=3) == "3"
+
+
+def test_fragment_cache_keeps_autoescaping(app, tmp_path):
+    (tmp_path / "page.html").write_text("{% cache 'page' %}{{ body }}{% endcache %}")
+    app = alcazar.Alcazar(templates_dir=str(tmp_path))
+
+    assert app.template("page.html", context={"body": "<b>"}) == "&lt;b&gt;"
+    assert app.template("page.html", context={"body": "<i>"}) == "&lt;b&gt;"
+
+
+def test_stream_template_yields_buffered_chunks(tmp_path):
+    (tmp_path / "report.html").write_text("<head></head>{% for row in rows %}<p>{{ row }}</p>{% endfor %}")
+    app = alcazar.Alcazar(templates_dir=str(tmp_path))
+
+    chunks = list(app.stream_template("report.html", context={"rows": range(100)}, buffer_size=50))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) >= 50 for chunk in chunks[:-1])
+    assert "".join(chunks) == app.template("report.html", context={"rows": range(100)})
+
+
+def test_stream_template_renders_lazily(tmp_path):
+    (tmp_path / "report.html").write_text("<head></head>{% for row in rows %}<p>{{ row }}</p>{% endfor %}")
+    app = alcazar.Alcazar(templates_dir=str(tmp_path))
+    produced = []
+
+    def rows():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    chunks = app.stream_template("report.html", context={"rows": rows()}, buffer_size=20)
+
+    assert next(chunks).startswith("<head></head>")
+    assert len(produced) < 100
+
+
+def test_stream_template_response(app, client):
+    @app.route("/html")
+    def html_handler(req, resp):
+        resp.stream = app.stream_template("example.html", context={"title": "Best Title", "body": "Best Body"})
+        resp.content_type = "text/html"
+
+    response = client.get(url("/html"))
+
+    assert "text/html" in response.headers["Content-Type"]
+    assert "Content-Length" not in response.headers
+    assert "Best Title" in response.text
@@ -0,0 +1,188 @@
+import json
+
+import pytest
+
+import alcazar
+from alcazar.middleware import Middleware
+from alcazar.orm import Database, Table, Column
+from alcazar.tracing import (
+    Tracer, RingBufferExporter, JSONLinesExporter, CallbackExporter, span, current_span, server_timing,
+)
+from alcazar.utils import url, asgi_request
+
+
+class Note(Table):
+    text = Column(str)
+
+
+@pytest.fixture
+def exporter():
+    return RingBufferExporter()
+
+
+@pytest.fixture
+def traced_app(exporter):
+    return alcazar.Alcazar(templates_dir="tests/templates", debug=False, tracer=Tracer([exporter]))
+
+
+def names(span):
+    return [child.name for child in span.children]
+
+
+def child(span, name):
+    return next(child for child in span.children if child.name == name)
+
+
+def test_spans_are_nested_per_request(traced_app, exporter, tmp_path):
+    db = Database(str(tmp_path / "notes.db"))
+    db.create(Note)
+
+    class Noop(Middleware):
+        def process_request(self, req):
+            pass
+
+    traced_app.add_middleware(Noop)
+
+    @traced_app.route("/notes")
+    def notes(req, resp):
+        db.all(Note)
+        resp.html = traced_app.template("example.html", context={"title": "Notes", "body": "Alcazar"})
+
+    traced_app.session().get(url("/notes"))
+
+    root, = exporter.traces
+    assert root.name == "request"
+    assert root.attributes == {"method": "GET", "path": "/notes", "status": 200}
+    assert names(root) == ["middleware.process_request", "find_route", "handler", "middleware.process_response"]
+
+    handler = child(root, "handler")
+    assert handler.attributes == {"route": "/notes"}
+    assert names(handler) == ["sql", "template"]
+    assert handler.children[0].attributes["statement"].startswith("SELECT")
+    assert handler.children[1].attributes["template"] == "example.html"
+    assert handler.duration >= handler.children[1].duration
+
+
+def test_server_timing_header(exporter):
+    app = alcazar.Alcazar(templates_dir="tests/templates", debug=False, tracer=Tracer([exporter], server_timing=True))
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "YOLO"
+
+    header = app.session().get(url("/")).headers["Server-Timing"]
+
+    assert "find_route;dur=" in header
+    assert "handler;dur=" in header
+    assert header.split(", ")[-1].startswith("total;dur=")
+
+
+def test_async_handlers_and_thread_pool_are_traced(traced_app, exporter):
+    @traced_app.route("/async")
+    async def async_handler(req, resp):
+        with span("work"):
+            resp.text = "async"
+
+    @traced_app.route("/sync")
+    def sync_handler(req, resp):
+        # sync handlers run in the thread pool under ASGI but still see the trace
+        assert current_span().name == "handler"
+        resp.text = "sync"
+
+    assert asgi_request(traced_app, "GET", "/async")[0] == 200
+    assert asgi_request(traced_app, "GET", "/sync")[0] == 200
+
+    async_root, sync_root = exporter.traces
+    assert names(child(async_root, "handler")) == ["work"]
+    assert sync_root.attributes["status"] == 200
+
+
+def test_spans_are_noops_without_a_trace():
+    assert current_span() is None
+    with span("orphan") as orphan:
+        orphan.set("key", "value")
+    assert current_span() is None
+
+
+def test_spans_record_errors(exporter):
+    with Tracer([exporter]).trace("job"):
+        with pytest.raises(ValueError):
+            with span("step"):
+                raise ValueError()
+
+    root, = exporter.traces
+    assert root.children[0].attributes == {"error": "ValueError"}
+
+
+def test_json_lines_and_callback_exporters(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    finished = []
+    tracer = Tracer([JSONLinesExporter(str(path)), CallbackExporter(finished.append)])
+
+    for _ in range(2):
+        with tracer.trace("job", kind="batch"):
+            with span("step"):
+                pass
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]["name"] == "job"
+    assert lines[0]["attributes"] == {"kind": "batch"}
+    assert lines[0]["children"][0]["name"] == "step"
+    assert "timestamp" in lines[0]
+    assert [root.name for root in finished] == ["job", "job"]
+    assert server_timing(finished[0]).startswith("step;dur=")
+
+
+def test_streamed_bodies_are_traced_until_closed(traced_app, exporter):
+    def rows():
+        for i in range(3):
+            with span("row", index=i):
+                yield f"{i}\n"
+
+    @traced_app.route("/export")
+    def export(req, resp):
+        resp.stream = rows()
+
+    @traced_app.route("/page")
+    def page(req, resp):
+        resp.stream = traced_app.stream_template("example.html", context={"title": "Page", "body": "Alcazar"})
+
+    def get(path):
+        # the test client never closes the body, which is what ends the trace
+        environ = {
+            "REQUEST_METHOD": "GET", "PATH_INFO": path, "SERVER_NAME": "testserver", "SERVER_PORT": "80",
+            "wsgi.url_scheme": "http",
+        }
+        body = traced_app(environ, lambda status, headers, exc_info=None: None)
+        assert not exporter.traces
+        try:
+            return b"".join(body)
+        finally:
+            body.close()
+
+    assert get("/export") == b"0\n1\n2\n"
+    export_root, = exporter.traces
+    exporter.traces.clear()
+    assert b"<h1>Alcazar</h1>" in get("/page")
+    page_root, = exporter.traces
+    assert names(export_root)[-3:] == ["row", "row", "row"]
+    assert export_root.duration >= sum(row.duration for row in export_root.children[-3:])
+    assert names(page_root)[-1] == "template"
+    assert current_span() is None
+
+
+def test_streamed_bodies_are_traced_under_asgi(traced_app, exporter):
+    def rows():
+        for i in range(3):
+            with span("row", index=i):
+                yield f"{i}\n"
+
+    @traced_app.route("/export")
+    def export(req, resp):
+        resp.stream = rows()
+
+    assert asgi_request(traced_app, "GET", "/export")[2] == b"0\n1\n2\n"
+
+    root, = exporter.traces
+    assert names(root)[-3:] == ["row", "row", "row"]